@@ -0,0 +1,462 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+import resource
+import requests
+import tempfile
+import itertools
+import threading
+import multiprocessing
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+idRegex = re.compile(r'/(\d+|[0-9a-f]{40})(?=/|$)')
+
+class StubState():
+    """
+    Torrents, history and request counts shared by the RealDebrid, TorBox and Arr stand-ins.
+    A torrent's status is derived from how long ago it was added, so progressions don't depend on anything polling it.
+    """
+    def __init__(self, config) -> None:
+        self.config = config
+        self.lock = threading.Lock()
+        self.torrents = {}
+        self.ids = itertools.count(1)
+        self.historyIds = itertools.count(1)
+        self.history = []
+        self.calls = {}
+
+    def count(self, method, path):
+        # Ids are folded so calls group by endpoint
+        key = f"{method} {idRegex.sub('/{id}', path)}"
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def add(self, provider, name, infoHash):
+        with self.lock:
+            torrentId = next(self.ids)
+            cached = self.isCached(infoHash)
+            self.torrents[torrentId] = {
+                'id': torrentId,
+                'provider': provider,
+                'name': name,
+                'hash': infoHash,
+                'added': time.monotonic(),
+                'selected': None if provider == 'realdebrid' else time.monotonic(),
+                'downloadSeconds': 0 if cached else self.config['downloadSeconds'],
+                'mounted': False
+            }
+        return torrentId
+
+    def isCached(self, infoHash):
+        return int(infoHash, 16) % 100 < self.config['cachedRatio'] * 100
+
+    def find(self, provider, torrentId):
+        torrent = self.torrents.get(int(torrentId))
+        return torrent if torrent and torrent['provider'] == provider else None
+
+    def progress(self, torrent):
+        """The torrent's stage and download progress between 0 and 1."""
+        now = time.monotonic()
+        if now - torrent['added'] < self.config['conversionSeconds']:
+            return 'converting', 0
+        if torrent['selected'] is None:
+            return 'selecting', 0
+
+        started = max(torrent['selected'], torrent['added'] + self.config['conversionSeconds'])
+        elapsed = now - started
+        if elapsed >= torrent['downloadSeconds']:
+            return 'finished', 1
+        return 'downloading', elapsed / torrent['downloadSeconds']
+
+    def mountDue(self):
+        """Create the mount folders of torrents that finished at least mountDelay seconds ago."""
+        now = time.monotonic()
+        for torrent in list(self.torrents.values()):
+            if torrent['mounted'] or self.progress(torrent)[0] != 'finished':
+                continue
+            finishedAt = max(torrent['selected'], torrent['added'] + self.config['conversionSeconds']) + torrent['downloadSeconds']
+            if now - finishedAt >= self.config['mountDelay']:
+                folder = os.path.join(self.config['mounts'][torrent['provider']], torrent['name'])
+                os.makedirs(folder, exist_ok=True)
+                with open(os.path.join(folder, f"{torrent['name']}.mkv"), 'wb') as f:
+                    f.truncate(self.config['fileBytes'])
+                torrent['mounted'] = True
+
+    def importCompleted(self):
+        """Import every folder in the completed folders that has been there longer than importDelay, as the Arr would."""
+        for completedPath in self.config['completedPaths']:
+            if not os.path.isdir(completedPath):
+                continue
+            for name in os.listdir(completedPath):
+                folder = os.path.join(completedPath, name)
+                if time.time() - os.path.getmtime(folder) < self.config['importDelay']:
+                    continue
+                with self.lock:
+                    for root, dirs, files in os.walk(folder):
+                        for filename in files:
+                            self.history.insert(0, {'id': next(self.historyIds), 'eventType': 'downloadFolderImported', 'sourceTitle': name, 'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), 'data': {'droppedPath': os.path.join(root, filename)}})
+                shutil.rmtree(folder, ignore_errors=True)
+
+def realDebridTorrent(state, torrent, full=False):
+    stage, progress = state.progress(torrent)
+    status = {'converting': 'magnet_conversion', 'selecting': 'waiting_files_selection', 'downloading': 'downloading', 'finished': 'downloaded'}[stage]
+    info = {'id': str(torrent['id']), 'filename': torrent['name'], 'hash': torrent['hash'], 'status': status, 'progress': progress * 100, 'bytes': state.config['fileBytes']}
+    if full:
+        info['original_filename'] = torrent['name']
+        info['files'] = [{'id': 1, 'path': f"/{torrent['name']}.mkv", 'bytes': state.config['fileBytes'], 'selected': int(torrent['selected'] is not None)}]
+    return info
+
+def torboxTorrent(state, torrent):
+    stage, progress = state.progress(torrent)
+    return {
+        'id': torrent['id'],
+        'name': torrent['name'],
+        'hash': torrent['hash'],
+        'download_state': {'converting': 'metaDL', 'downloading': 'downloading'}.get(stage, 'completed'),
+        'download_finished': stage == 'finished',
+        'progress': progress,
+        'files': [{'id': 0, 'name': f"{torrent['name']}/{torrent['name']}.mkv", 'size': state.config['fileBytes']}]
+    }
+
+def getNameAndHash(data):
+    """The release name and infohash of a magnet link or one of the .torrent files written by dropFiles."""
+    magnetMatch = re.search(rb'btih(?::|%3A)([0-9a-fA-F]{40})', data)
+    if magnetMatch:
+        nameMatch = re.search(rb'dn=([^&\s]+)', data)
+        return nameMatch.group(1).decode(), magnetMatch.group(1).decode().lower()
+
+    nameMatch = re.search(rb'4:name(\d+):', data)
+    # The info dictionary is the last key of the generated torrents
+    infoStart = data.index(b'4:info') + len(b'4:info')
+    return data[nameMatch.end():nameMatch.end() + int(nameMatch.group(1))].decode(), hashlib.sha1(data[infoStart:-1]).hexdigest()
+
+def makeHandler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def respond(self, code, body=None, headers={}):
+            data = b'' if body is None else json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def readBody(self):
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def handle(self):
+            try:
+                super().handle()
+            except ConnectionError:
+                pass
+
+        def route(self, method):
+            url = urlsplit(self.path)
+            path = url.path
+            query = parse_qs(url.query)
+            if path == '/_stats':
+                with state.lock:
+                    return self.respond(200, state.calls)
+
+            time.sleep(state.config['latency'])
+            state.count(method, path)
+
+            if path.startswith('/rd/'):
+                return self.realDebrid(method, path[len('/rd/'):], query)
+            elif path.startswith('/torbox/'):
+                return self.torbox(method, path[len('/torbox/'):], query)
+            elif path.startswith('/relay/'):
+                return self.respond(200, {})
+            elif path == '/login':
+                return self.respond(200, {})
+            elif path.startswith('/api/v3/'):
+                return self.arr(method, path[len('/api/v3/'):], query)
+            self.respond(404, {'path': path})
+
+        def realDebrid(self, method, path, query):
+            if path in ('time', 'user'):
+                return self.respond(200, {})
+            elif path == 'torrents/availableHosts':
+                return self.respond(200, [{'host': 'stub'}])
+            elif path in ('torrents/addTorrent', 'torrents/addMagnet'):
+                data = self.readBody()
+                if path == 'torrents/addMagnet':
+                    data = parse_qs(data.decode())['magnet'][0].encode()
+                torrentId = state.add('realdebrid', *getNameAndHash(data))
+                return self.respond(201, {'id': str(torrentId)})
+            elif path == 'torrents':
+                page = int(query.get('page', ['1'])[0])
+                limit = int(query.get('limit', ['100'])[0])
+                torrents = sorted((torrent for torrent in list(state.torrents.values()) if torrent['provider'] == 'realdebrid'), key=lambda torrent: -torrent['id'])
+                chunk = torrents[(page - 1) * limit:page * limit]
+                if not chunk:
+                    return self.respond(204)
+                return self.respond(200, [realDebridTorrent(state, torrent) for torrent in chunk], {'X-Total-Count': str(len(torrents))})
+
+            match = re.fullmatch(r'torrents/(info|selectFiles|delete)/(\d+)', path)
+            torrent = match and state.find('realdebrid', match.group(2))
+            if not torrent:
+                return self.respond(404, {'error': 'unknown_ressource'})
+            elif match.group(1) == 'info':
+                return self.respond(200, realDebridTorrent(state, torrent, full=True))
+            elif match.group(1) == 'selectFiles':
+                self.readBody()
+                torrent['selected'] = time.monotonic()
+                return self.respond(204)
+            else:
+                state.torrents.pop(torrent['id'], None)
+                return self.respond(204)
+
+        def torbox(self, method, path, query):
+            if path == 'stats':
+                return self.respond(200, {})
+            elif path == 'user/me':
+                return self.respond(200, {'data': {'auth_id': 'stub'}})
+            elif path == 'torrents/checkcached':
+                hashes = [infoHash for value in query['hash'] for infoHash in value.split(',')]
+                return self.respond(200, {'data': {infoHash: {'name': infoHash, 'hash': infoHash} for infoHash in hashes if state.isCached(infoHash)}})
+            elif path == 'torrents/mylist' and 'id' in query:
+                torrent = state.find('torbox', query['id'][0])
+                return self.respond(200, {'data': torboxTorrent(state, torrent) if torrent else None})
+            elif path == 'torrents/mylist':
+                return self.respond(200, {'data': [torboxTorrent(state, torrent) for torrent in list(state.torrents.values()) if torrent['provider'] == 'torbox']})
+            elif path == 'torrents/createtorrent':
+                data = self.readBody()
+                if b'magnet=' in data:
+                    data = parse_qs(data.decode())['magnet'][0].encode()
+                else:
+                    # Pull the .torrent out of the multipart upload
+                    data = re.search(rb'd8:announce.*?ee(?=\r\n--)', data, re.DOTALL).group(0)
+                torrentId = state.add('torbox', *getNameAndHash(data))
+                return self.respond(200, {'data': {'torrent_id': torrentId}})
+            elif path == 'torrents/controltorrent':
+                torrentId = parse_qs(self.readBody().decode())['torrent_id'][0]
+                state.torrents.pop(int(torrentId), None)
+                return self.respond(200, {'success': True})
+            self.respond(404, {'path': path})
+
+        def arr(self, method, path, query):
+            if path == 'system/status':
+                return self.respond(200, {})
+            elif path == 'command':
+                self.readBody()
+                state.importCompleted()
+                return self.respond(201, {'id': 1})
+            elif path == 'history':
+                pageSize = int(query.get('pageSize', ['10'])[0])
+                page = int(query.get('page', ['1'])[0])
+                with state.lock:
+                    records = list(state.history)
+                return self.respond(200, {'records': records[(page - 1) * pageSize:page * pageSize], 'page': page, 'pageSize': pageSize, 'totalRecords': len(records)})
+            self.respond(404, {'path': path})
+
+        def do_GET(self):
+            self.route('GET')
+
+        def do_POST(self):
+            self.route('POST')
+
+        def do_PUT(self):
+            self.route('PUT')
+
+        def do_DELETE(self):
+            self.route('DELETE')
+
+    return StubHandler
+
+def serveStubs(config, ports):
+    """Run the stand-ins in their own process, so they don't count towards blackhole's CPU or memory."""
+    state = StubState(config)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), makeHandler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports.put(server.server_port)
+
+    while True:
+        state.mountDue()
+        time.sleep(0.05)
+
+def makeTorrent(name):
+    info = b'd6:lengthi%de4:name%d:%s12:piece lengthi262144e6:pieces20:%se' % (1024 * 1024, len(name), name.encode(), hashlib.sha1(name.encode()).digest())
+    announce = b'http://stub/announce'
+    return b'd8:announce%d:%s4:info%se' % (len(announce), announce, info)
+
+def makeMagnet(name):
+    return f"magnet:?xt=urn:btih:{hashlib.sha1(name.encode()).hexdigest()}&dn={name}"
+
+def dropFiles(watchPath, names, kind, interval, onDrop):
+    """Write the .torrent/.magnet files into the watch path, returning when each was dropped."""
+    dropped = {}
+    for i, name in enumerate(names):
+        isTorrent = kind == 'torrent' or (kind == 'mixed' and i % 2)
+        path = os.path.join(watchPath, f"{name}.torrent" if isTorrent else f"{name}.magnet")
+        # Written beside the watch path and moved in, so the file is never picked up half written
+        partialPath = os.path.join(os.path.dirname(watchPath), os.path.basename(path))
+        with open(partialPath, 'wb') as f:
+            f.write(makeTorrent(name) if isTorrent else makeMagnet(name).encode())
+        dropped[name] = time.monotonic()
+        os.replace(partialPath, path)
+        if interval:
+            onDrop()
+            time.sleep(interval)
+    onDrop()
+    return dropped
+
+def watchCompleted(completedPath, names, linked, stop):
+    """Record when each release's folder first shows up in the completed folder with a link inside it."""
+    while not stop.is_set():
+        if os.path.isdir(completedPath):
+            for name in os.listdir(completedPath):
+                if name in names and name not in linked and os.listdir(os.path.join(completedPath, name)):
+                    linked[name] = time.monotonic()
+        time.sleep(0.01)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else float('nan')
+
+async def runBlackhole(watchPath, names, args, linked):
+    # Imported here since blackhole reads its settings from the environment when imported
+    import blackhole
+    from shared.requests import closeAsyncClient
+
+    ingestor = blackhole.Ingestor(isRadarr=False, workers=args.workers)
+    runTask = asyncio.create_task(ingestor.run())
+    processingPath = os.path.join(watchPath, 'processing')
+
+    dropped = await asyncio.to_thread(dropFiles, watchPath, names, args.kind, args.interval, ingestor.notifyThreadsafe)
+
+    deadline = time.monotonic() + args.timeout
+    done = False
+    while not done and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        remaining = [name for name in os.listdir(watchPath) if name not in ('processing', 'completed')]
+        done = not remaining and not [name for name in os.listdir(processingPath) if not name.startswith('.')]
+    finished = time.monotonic()
+
+    runTask.cancel()
+    await asyncio.gather(runTask, return_exceptions=True)
+    await closeAsyncClient()
+    return dropped, finished, done
+
+def main():
+    parser = argparse.ArgumentParser(description='Run blackhole end to end against local RealDebrid, TorBox and Arr stand-ins and report its throughput.')
+    parser.add_argument('--files', type=int, default=50, help='Number of .torrent/.magnet files to drop')
+    parser.add_argument('--kind', choices=['magnet', 'torrent', 'mixed'], default='mixed', help='Type of file to drop')
+    parser.add_argument('--providers', choices=['realdebrid', 'torbox', 'both'], default='realdebrid', help='Debrid providers to enable')
+    parser.add_argument('--workers', type=int, default=None, help='Files processed at once, defaults to BLACKHOLE_WORKERS')
+    parser.add_argument('--interval', type=float, default=0, help='Seconds between dropping files, 0 drops them all at once')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds every stub request takes')
+    parser.add_argument('--conversion-seconds', type=float, default=1, help='Seconds a torrent takes before its files can be selected')
+    parser.add_argument('--download-seconds', type=float, default=5, help='Seconds an uncached torrent takes to download')
+    parser.add_argument('--fail-if-not-cached', action='store_true', help='Set BLACKHOLE_FAIL_IF_NOT_CACHED, failing uncached torrents back to the Arr')
+    parser.add_argument('--cached-ratio', type=float, default=0.8, help='Fraction of torrents that are already cached')
+    parser.add_argument('--mount-delay', type=float, default=1, help='Seconds between a torrent finishing and its folder appearing in the mount')
+    parser.add_argument('--import-delay', type=float, default=0.5, help='Seconds a completed folder must exist before the Arr imports it')
+    parser.add_argument('--file-bytes', type=int, default=1024 * 1024, help='Size of each media file in the mount')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for every file to be processed')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directory')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='blackhole-benchmark-')
+    mounts = {'realdebrid': os.path.join(root, 'mount', 'realdebrid'), 'torbox': os.path.join(root, 'mount', 'torbox')}
+    for mount in mounts.values():
+        # The mount path checks need at least one folder in each mount
+        os.makedirs(os.path.join(mount, 'seed'))
+    watchPath = os.path.join(root, 'watch', 'sonarr')
+    completedPath = os.path.join(watchPath, 'completed')
+
+    config = {
+        'latency': args.latency,
+        'conversionSeconds': args.conversion_seconds,
+        'downloadSeconds': args.download_seconds,
+        'cachedRatio': args.cached_ratio,
+        'mountDelay': args.mount_delay,
+        'importDelay': args.import_delay,
+        'fileBytes': args.file_bytes,
+        'mounts': mounts,
+        'completedPaths': [completedPath]
+    }
+    ports = multiprocessing.Queue()
+    stubProcess = multiprocessing.Process(target=serveStubs, args=(config, ports), daemon=True)
+    stubProcess.start()
+    stubUrl = f"http://127.0.0.1:{ports.get(timeout=30)}"
+
+    os.environ.update({
+        'REALDEBRID_ENABLED': str(args.providers in ('realdebrid', 'both')).lower(),
+        'REALDEBRID_HOST': f"{stubUrl}/rd/",
+        'REALDEBRID_API_KEY': 'benchmark',
+        'REALDEBRID_MOUNT_TORRENTS_PATH': mounts['realdebrid'],
+        'TORBOX_ENABLED': str(args.providers in ('torbox', 'both')).lower(),
+        'TORBOX_HOST': f"{stubUrl}/torbox/",
+        'TORBOX_RELAY_HOST': f"{stubUrl}/relay/",
+        'TORBOX_API_KEY': 'benchmark',
+        'TORBOX_MOUNT_TORRENTS_PATH': mounts['torbox'],
+        'SONARR_HOST': stubUrl,
+        'SONARR_API_KEY': 'benchmark',
+        'RADARR_HOST': stubUrl,
+        'RADARR_API_KEY': 'benchmark',
+        'BLACKHOLE_BASE_WATCH_PATH': os.path.join(root, 'watch'),
+        'BLACKHOLE_SONARR_PATH': 'sonarr',
+        'BLACKHOLE_RADARR_PATH': 'radarr',
+        'BLACKHOLE_FAIL_IF_NOT_CACHED': str(args.fail_if_not_cached).lower(),
+        'BLACKHOLE_RD_MOUNT_REFRESH_SECONDS': '60',
+        'BLACKHOLE_WAIT_FOR_TORRENT_TIMEOUT': '600',
+        'BLACKHOLE_HISTORY_PAGE_SIZE': '500',
+        'BLACKHOLE_JOURNAL_PATH': os.path.join(root, 'journal.db'),
+        'BLACKHOLE_INSTANCES': '',
+        'DISCORD_ENABLED': 'false',
+        'DISCORD_UPDATE_ENABLED': 'false'
+    })
+    os.makedirs(os.path.join(watchPath, 'processing'))
+
+    names = [f"Benchmark.Show.S01E{i + 1:03d}.1080p.WEB-DL" for i in range(args.files)]
+    linked = {}
+    stop = threading.Event()
+    watcher = threading.Thread(target=watchCompleted, args=(completedPath, set(names), linked, stop), daemon=True)
+    watcher.start()
+
+    start = time.monotonic()
+    try:
+        dropped, finished, done = asyncio.run(runBlackhole(watchPath, names, args, linked))
+    finally:
+        stop.set()
+        watcher.join()
+
+    calls = requests.get(f"{stubUrl}/_stats").json()
+    stubProcess.terminate()
+
+    seconds = finished - start
+    timesToLink = [linked[name] - dropped[name] for name in names if name in linked]
+    totalCalls = sum(calls.values())
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    print(f"Files: {len(timesToLink)}/{args.files} linked, {args.files - len(timesToLink)} not, in {seconds:.1f}s ({args.files / seconds * 60:.1f} files/min)" if done else f"Timed out after {seconds:.1f}s with {len(timesToLink)}/{args.files} linked")
+    print(f"Time to symlink: p50 {percentile(timesToLink, 0.5):.2f}s, p95 {percentile(timesToLink, 0.95):.2f}s, max {max(timesToLink, default=float('nan')):.2f}s")
+    print(f"API calls: {totalCalls} ({totalCalls / args.files:.1f} per file)")
+    for key, count in sorted(calls.items(), key=lambda item: -item[1]):
+        print(f"  {count:>8} {count / args.files:8.2f}/file  {key}")
+    print(f"Peak RSS: {peakRss / 1024 / 1024:.1f} MiB")
+
+    if args.keep:
+        print(f"Kept {root}")
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if not done:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
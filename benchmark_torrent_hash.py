@@ -0,0 +1,61 @@
+import os
+import time
+import hashlib
+import argparse
+import tracemalloc
+from shared.debrid import scanTorrent
+
+def bencode3Hash(data):
+    import bencode3
+    return hashlib.sha1(bencode3.bencode(bencode3.bdecode(data)['info'])).hexdigest()
+
+def scanTorrentHash(data):
+    return scanTorrent(data).infoHash
+
+def measure(hashFunc, corpus, iterations):
+    """Return the mean seconds per file and the peak bytes allocated while hashing the corpus once."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for data in corpus.values():
+            hashFunc(data)
+    seconds = (time.perf_counter() - start) / (iterations * len(corpus))
+
+    tracemalloc.start()
+    for data in corpus.values():
+        hashFunc(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the streaming infohash scanner against decoding and re-encoding with bencode3.')
+    parser.add_argument('directory', type=str, help='Directory of .torrent files to use as the corpus')
+    parser.add_argument('--iterations', type=int, default=20, help='Number of passes over the corpus to time')
+    args = parser.parse_args()
+
+    corpus = {}
+    for filename in sorted(os.listdir(args.directory)):
+        if filename.casefold().endswith('.torrent'):
+            with open(os.path.join(args.directory, filename), 'rb') as f:
+                corpus[filename] = f.read()
+
+    if not corpus:
+        parser.error(f"No .torrent files found in {args.directory}")
+
+    mismatches = [filename for filename, data in corpus.items() if scanTorrentHash(data) != bencode3Hash(data)]
+    for filename in mismatches:
+        print(f"Hash mismatch: {filename}")
+
+    totalBytes = sum(len(data) for data in corpus.values())
+    fileCount = sum(len(scanTorrent(data).files) for data in corpus.values())
+    print(f"Corpus: {len(corpus)} torrents, {totalBytes / 1024 / 1024:.1f} MiB, {fileCount} files")
+
+    results = {name: measure(hashFunc, corpus, args.iterations) for name, hashFunc in [('bencode3', bencode3Hash), ('scanTorrent', scanTorrentHash)]}
+    for name, (seconds, peak) in results.items():
+        print(f"{name:>12}: {seconds * 1e6:10.1f} us/torrent, peak {peak / 1024:10.1f} KiB")
+
+    print(f"Speedup: {results['bencode3'][0] / results['scanTorrent'][0]:.1f}x")
+
+if __name__ == '__main__':
+    main()
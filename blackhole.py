@@ -1,4 +1,3 @@
-import shutil
 import time
 import traceback
 import os
@@ -7,12 +6,18 @@ import re
 import requests
 import asyncio
 import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime
 # import urllib
 from shared.discord import discordError, discordUpdate
-from shared.shared import realdebrid, torbox, blackhole, plex, checkRequiredEnvs
-from shared.arr import Arr, Radarr, Sonarr
-from shared.debrid import TorrentBase, RealDebridTorrent, RealDebridMagnet, TorboxTorrent, TorboxMagnet
+from shared.shared import realdebrid, torbox, blackhole, blackholeInstances, plex, checkRequiredEnvs
+from shared.arr import Arr, Radarr, Sonarr, RefreshScheduler, HistoryIndex
+from shared.requests import closeAsyncClient
+from shared.links import LinkPlan, buildLinkPlan, materializeLinkPlan
+from shared.mount import WarmupPool, CopyPool
+from shared.metrics import registry, stageSeconds, torrentsProcessed
+from shared.journal import Journal, ProviderStatsEntry, STATE_RENAMED, STATE_SUBMITTED, STATE_FILES_SELECTED, STATE_COMPLETED, STATE_LINKED, STATE_FAILED
+from shared.debrid import TorrentBase, RealDebrid, Torbox, RealDebridTorrent, RealDebridMagnet, TorboxTorrent, TorboxMagnet, TorboxCacheChecker, PollingPolicy, normalizeHash
 
 _print = print
 
@@ -29,6 +34,14 @@ requiredEnvs = {
     'Blackhole history page size': (blackhole['historyPageSize'],)
 }
 
+for instance in blackholeInstances[1:]:
+    requiredEnvs.update({
+        f"Sonarr host ({instance['name']})": (instance['sonarrHost'],),
+        f"Sonarr API key ({instance['name']})": (instance['sonarrApiKey'],),
+        f"Radarr host ({instance['name']})": (instance['radarrHost'],),
+        f"Radarr API key ({instance['name']})": (instance['radarrApiKey'],)
+    })
+
 checkRequiredEnvs(requiredEnvs)
 
 class TorrentFileInfo():
@@ -45,41 +58,60 @@ class TorrentFileInfo():
             self.isTorrentOrMagnet = isTorrentOrMagnet
             self.isDotTorrentFile = isDotTorrentFile
 
-    def __init__(self, filename, isRadarr) -> None:
+    def __init__(self, filename, isRadarr, filePathProcessing=None, watchPath=None, maxNameBytes=None) -> None:
+        """
+        Pass filePathProcessing to resume a file already moved to the processing folder by a previous run.
+        Pass maxNameBytes to skip looking up the watch path's maximum filename length.
+        """
         print('filename:', filename)
-        baseBath = getPath(isRadarr)
-        uniqueId = str(uuid.uuid4())[:8]
+        baseBath = getPath(isRadarr, watchPath=watchPath)
         isDotTorrentFile = filename.casefold().endswith('.torrent')
         isTorrentOrMagnet = isDotTorrentFile or filename.casefold().endswith('.magnet')
         filenameWithoutExt, ext = os.path.splitext(filename)
         filePath = os.path.join(baseBath, filename)
 
-        # Get the maximum filename length for the target directory
-        try:
-            maxNameBytes = os.pathconf(baseBath, 'PC_NAME_MAX')
-        except (AttributeError, ValueError, OSError):
-            maxNameBytes = 255
+        if filePathProcessing is None:
+            uniqueId = str(uuid.uuid4())[:8]
 
-        # Calculate space needed for uniqueId, separator, and extension
-        extraBytes = len(f"_{uniqueId}{ext}".encode())
-        
-        # Truncate the filename if needed
-        if len(filenameWithoutExt.encode()) > maxNameBytes - extraBytes:
-            processingName = truncateBytes(filenameWithoutExt, maxNameBytes - extraBytes)
-            print(f"Truncated filename from {len(filenameWithoutExt.encode())} to {len(processingName.encode())} bytes")
+            if maxNameBytes is None:
+                maxNameBytes = getMaxNameBytes(baseBath)
+
+            # Calculate space needed for uniqueId, separator, and extension
+            extraBytes = len(f"_{uniqueId}{ext}".encode())
+            
+            # Truncate the filename if needed
+            if len(filenameWithoutExt.encode()) > maxNameBytes - extraBytes:
+                processingName = truncateBytes(filenameWithoutExt, maxNameBytes - extraBytes)
+                print(f"Truncated filename from {len(filenameWithoutExt.encode())} to {len(processingName.encode())} bytes")
+            else:
+                processingName = filenameWithoutExt
+
+            filePathProcessing = os.path.join(baseBath, 'processing', f"{processingName}_{uniqueId}{ext}")
+            self.isResumed = False
         else:
-            processingName = filenameWithoutExt
+            self.isResumed = True
 
-        filePathProcessing = os.path.join(baseBath, 'processing', f"{processingName}_{uniqueId}{ext}")
         folderPathCompleted = os.path.join(baseBath, 'completed', filenameWithoutExt)
         
         self.fileInfo = self.FileInfo(filename, filenameWithoutExt, filePath, filePathProcessing, folderPathCompleted)
         self.torrentInfo = self.TorrentInfo(isTorrentOrMagnet, isDotTorrentFile)
 
-def getPath(isRadarr, create=False):
+def getMaxNameBytes(path):
+    """The maximum filename length in bytes for the directory."""
+    try:
+        return os.pathconf(path, 'PC_NAME_MAX')
+    except (AttributeError, ValueError, OSError):
+        return 255
+
+def getJournal(filePathProcessing):
+    # Kept next to the processing files by default so it lives on the same persistent volume
+    return Journal.forPath(blackhole['journalPath'] or os.path.join(os.path.dirname(filePathProcessing), '.blackhole.db'))
+
+def getPath(isRadarr, create=False, watchPath=None):
+    """Pass watchPath to use another instance's path under the base watch path."""
     baseWatchPath = blackhole['baseWatchPath']
     absoluteBaseWatchPath = baseWatchPath if os.path.isabs(baseWatchPath) else os.path.abspath(baseWatchPath)
-    finalPath = os.path.join(absoluteBaseWatchPath, blackhole['radarrPath'] if isRadarr else blackhole['sonarrPath'])
+    finalPath = os.path.join(absoluteBaseWatchPath, watchPath or (blackhole['radarrPath'] if isRadarr else blackhole['sonarrPath']))
 
     if create:
         for sub_path in ['', 'processing', 'completed']:
@@ -89,188 +121,452 @@ def getPath(isRadarr, create=False):
         
     return finalPath
 
-# From Radarr Radarr/src/NzbDrone.Core/Organizer/FileNameBuilder.cs
-def cleanFileName(name):
-    result = name
-    badCharacters = ["\\", "/", "<", ">", "?", "*", ":", "|", "\""]
-    goodCharacters = ["+", "+", "", "", "!", "-", "", "", ""]
-
-    for i, char in enumerate(badCharacters):
-        result = result.replace(char, goodCharacters[i])
-    
-    return result.strip()
-
-refreshingTask = None
-
 def truncateBytes(text: str, maxBytes: int) -> str:
     """Truncate a string to a maximum number of bytes in UTF-8 encoding."""
     encoded = text.encode()
     return encoded[:maxBytes].decode(errors='ignore')
 
-async def refreshArr(arr: Arr, count=60):
-    # TODO: Change to refresh until found/imported
-    async def refresh():
-        for _ in range(count):
-            arr.refreshMonitoredDownloads()
-            await asyncio.sleep(1)
+async def refreshArr(arr: Arr, folderPathsCompleted, count=60):
+    """Refresh the arr's monitored downloads until the completed folders have been imported, or count refreshes have been sent."""
+    folderNames = [os.path.basename(folderPath) for folderPath in folderPathsCompleted]
+    imported = await RefreshScheduler.forArr(arr).refresh(folderNames, maxRefreshes=count)
+    print('Imported:' if imported else 'Import not seen after refreshing:', ', '.join(folderNames))
+    return imported
+
+class ProviderScheduler():
+    """
+    Admission control for torrents in flight on a debrid provider.
+    Torrents beyond the limit wait for a free slot in arrival order instead of being submitted.
+    """
+    def __init__(self, name, limit) -> None:
+        self.name = name
+        self.limit = limit
+        self.semaphore = None
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.totalWaitSeconds = 0
+        self.maxWaitSeconds = 0
+
+    @asynccontextmanager
+    async def admit(self, print=print):
+        start = time.monotonic()
+        if self.limit:
+            if self.semaphore is None:
+                # Created lazily so it binds to the running loop
+                self.semaphore = asyncio.Semaphore(self.limit)
+            if self.semaphore.locked():
+                print(f"Waiting for a {self.name} slot ({self.stats()})")
+
+            self.waiting += 1
+            try:
+                await self.semaphore.acquire()
+            finally:
+                self.waiting -= 1
+
+        waitSeconds = time.monotonic() - start
+        self.admitted += 1
+        self.totalWaitSeconds += waitSeconds
+        self.maxWaitSeconds = max(self.maxWaitSeconds, waitSeconds)
+        if waitSeconds >= 1:
+            print(f"Admitted to {self.name} after {waitSeconds:.1f}s ({self.stats()})")
+
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            if self.limit:
+                self.semaphore.release()
+
+    def stats(self):
+        averageWaitSeconds = self.totalWaitSeconds / self.admitted if self.admitted else 0
+        return f"in flight: {self.inflight}/{self.limit or 'unlimited'}, queue depth: {self.waiting}, average wait: {averageWaitSeconds:.1f}s, max wait: {self.maxWaitSeconds:.1f}s"
+
+providerSchedulers = {
+    RealDebrid: ProviderScheduler('RealDebrid', blackhole['rdMaxInflight']),
+    Torbox: ProviderScheduler('Torbox', blackhole['torboxMaxInflight'])
+}
 
-    global refreshingTask
-    if refreshingTask and not refreshingTask.done():
-        print("Refresh already in progress, restarting...")
-        refreshingTask.cancel()
+def getProviderScheduler(torrent: TorrentBase) -> ProviderScheduler:
+    return next(scheduler for provider, scheduler in providerSchedulers.items() if isinstance(torrent, provider))
+
+class ProviderStats():
+    """
+    Rolling averages per provider of how often torrents are cached, how often it errors or times out, and how long hits and misses take,
+    persisted in the journal. Sequential mode tries the providers in order of expected time until the file is available.
+    Averages drift back to the prior while a provider goes unused, so one that was degraded gets tried first again eventually.
+    """
+    OUTCOME_HIT = 'hit'
+    OUTCOME_MISS = 'miss'
+    OUTCOME_ERROR = 'error'
+    _stats = {}
+
+    @classmethod
+    def forJournal(cls, journal: Journal):
+        if journal.path not in cls._stats:
+            cls._stats[journal.path] = cls(journal)
+        return cls._stats[journal.path]
+
+    def __init__(self, journal: Journal, alpha=0.2, halfLifeSeconds=3600, prior=(0.9, 0, 30, 30)) -> None:
+        self.journal = journal
+        self.alpha = alpha
+        self.halfLifeSeconds = halfLifeSeconds
+        # hitRate, errorRate, hitSeconds, missSeconds
+        self.prior = prior
+        self.entries = journal.getProviderStats()
+
+    def get(self, provider) -> ProviderStatsEntry:
+        """The provider's averages, decayed towards the prior by how long ago they were last updated."""
+        entry = self.entries.get(provider)
+        if entry is None:
+            return ProviderStatsEntry(provider, *self.prior, 0, time.time())
+
+        weight = 0.5 ** (max(time.time() - entry.updated, 0) / self.halfLifeSeconds)
+        values = (entry.hitRate, entry.errorRate, entry.hitSeconds, entry.missSeconds)
+        return ProviderStatsEntry(provider, *(prior + (value - prior) * weight for value, prior in zip(values, self.prior)), entry.samples, entry.updated)
+
+    def record(self, provider, outcome, seconds):
+        entry = self.get(provider)
+        # Early samples count for more, so the prior is forgotten quickly
+        alpha = max(self.alpha, 1 / (entry.samples + 2))
+        isError = outcome == self.OUTCOME_ERROR
+
+        entry.errorRate += alpha * (isError - entry.errorRate)
+        if not isError:
+            entry.hitRate += alpha * ((outcome == self.OUTCOME_HIT) - entry.hitRate)
+        if outcome == self.OUTCOME_HIT:
+            entry.hitSeconds += alpha * (seconds - entry.hitSeconds)
+        else:
+            entry.missSeconds += alpha * (seconds - entry.missSeconds)
+        entry.samples += 1
+        entry.updated = time.time()
+
+        self.entries[provider] = entry
+        self.journal.recordProviderStats(entry)
+
+    def expectedSeconds(self, provider):
+        """Expected seconds spent on the provider per file it makes available, the order that minimises the expected total wait."""
+        entry = self.get(provider)
+        success = entry.hitRate * (1 - entry.errorRate)
+        cost = success * entry.hitSeconds + (1 - success) * entry.missSeconds
+        return cost / max(success, 0.01)
+
+    def order(self, torrentConstructors):
+        # Stable, so providers without stats keep the configured order
+        return sorted(torrentConstructors, key=lambda constructor: self.expectedSeconds(constructor.provider))
+
+def getProviderStatsValues(attribute):
+    return {(os.path.basename(stats.journal.path), provider): getattr(stats.get(provider), attribute) for stats in list(ProviderStats._stats.values()) for provider in list(stats.entries)}
+
+registry.gauge('blackhole_provider_hit_rate', 'Rolling fraction of torrents the provider had cached', ('journal', 'provider'), lambda: getProviderStatsValues('hitRate'))
+registry.gauge('blackhole_provider_error_rate', 'Rolling fraction of torrents that errored or timed out on the provider', ('journal', 'provider'), lambda: getProviderStatsValues('errorRate'))
+registry.gauge('blackhole_provider_expected_seconds', 'Expected seconds spent on the provider per file it makes available', ('journal', 'provider'), lambda: {(os.path.basename(stats.journal.path), provider): stats.expectedSeconds(provider) for stats in list(ProviderStats._stats.values()) for provider in list(stats.entries)})
+
+raceDelays = {
+    RealDebrid: blackhole['rdRaceDelay'],
+    Torbox: blackhole['torboxRaceDelay']
+}
 
-    refreshingTask = asyncio.create_task(refresh())
+class ProviderRace():
+    """
+    Races a file's torrent on every enabled provider. The first whose folder shows up in the mount claims the file and links it,
+    the others are cancelled and deleted from their accounts instead of polling on until they finish or time out.
+    """
+    def __init__(self, file: TorrentFileInfo, arr: Arr) -> None:
+        self.file = file
+        self.arr = arr
+        self.winner = None
+        self.tasks = {}
+        self.removals = []
+        self.failed = None
+
+    async def run(self, torrents):
+        """:return: Whether any provider linked the file."""
+        self.failed = asyncio.Event()
+        self.tasks = {torrent: asyncio.create_task(self._race(torrent)) for torrent in torrents}
+        results = await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+        # Shielded so a shutdown mid-cleanup doesn't leave the losing copies on the accounts
+        await asyncio.shield(asyncio.gather(*self.removals))
+        for torrent in self.tasks:
+            releaseAttachments(torrent)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return any(result is True for result in results)
+
+    def claim(self, torrent: TorrentBase):
+        """Claim the file for torrent, cancelling the rest. Returns False if another provider got there first."""
+        if self.winner is None:
+            self.winner = torrent
+            for other, task in self.tasks.items():
+                if other is not torrent:
+                    task.cancel()
+                    # Deleted as soon as the loser stops, rather than holding its provider slot until the winner is imported
+                    self.removals.append(asyncio.create_task(self._removeLoser(other, task)))
+        return self.winner is torrent
+
+    async def _race(self, torrent: TorrentBase):
+        delay = next(delay for provider, delay in raceDelays.items() if isinstance(torrent, provider))
+        if delay:
+            try:
+                # A head start for the other providers, cut short if they fail
+                await asyncio.wait_for(self.failed.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+        processed = await processTorrent(torrent, self.file, self.arr, self)
+        if not processed:
+            self.failed.set()
+        return processed
+
+    async def _removeLoser(self, torrent: TorrentBase, task: asyncio.Task):
+        # Waits out an add in progress, which may still give the torrent an id
+        await asyncio.wait([task])
+        if torrent.id is None:
+            return
+
+        if torrent.attached or torrentAttachments.get((torrent.provider, torrent.id)):
+            # Shared with another file, which still needs it
+            torrent.print('Lost the race, keeping it for the other files using it')
+            return
+        torrent.print('Lost the race, deleting')
+        await torrent.delete()
+        getJournal(self.file.fileInfo.filePathProcessing).recordTorrent(self.file.fileInfo.filePathProcessing, torrent.provider, STATE_FAILED)
+
+registry.gauge('blackhole_provider_waiting', 'Torrents waiting for a free provider slot', ('provider',), lambda: {(scheduler.name,): scheduler.waiting for scheduler in providerSchedulers.values()})
+registry.gauge('blackhole_provider_wait_seconds_max', 'Longest wait for a free provider slot', ('provider',), lambda: {(scheduler.name,): scheduler.maxWaitSeconds for scheduler in providerSchedulers.values()})
+
+async def submitTorrent(torrent: TorrentBase) -> bool:
+    """Submit the torrent, letting an add already sent to the provider finish even if cancelled, so it gets an id to be deleted by rather than orphaned."""
+    submission = asyncio.create_task(torrent.submitTorrent())
     try:
-        await refreshingTask
+        return await asyncio.shield(submission)
     except asyncio.CancelledError:
-        pass
-
-def copyFiles(file: TorrentFileInfo, folderPathMountTorrent, arr: Arr):
-    # Consider removing this and always streaming
-    try:
-        _print = globals()['print']
-
-        def print(*values: object):
-            _print(f"[{file.fileInfo.filenameWithoutExt}]", *values)
-
-        count = 0
-        print('Waiting for arr to delete folders...')
-        while True:
-            count += 1
-            if not os.path.exists(file.fileInfo.folderPathCompleted):
-                print('Deleted')
-                print('Copying actual files to arr folder...')
-                shutil.copytree(folderPathMountTorrent, file.fileInfo.folderPathCompleted)
-                arr.refreshMonitoredDownloads()   
-                print('Copied')          
-                break
-            time.sleep(1)
-            if count == 180:
-                print('copyCount > 180')
-                discordError(f"{file.fileInfo.filenameWithoutExt} copy attempt acount > 180", "Shortcut has not finished importing yet")
+        await submission
+        raise
 
-    except:
-        e = traceback.format_exc()
-
-        print(f"Error copying files for {file.fileInfo.filenameWithoutExt}")
-        print(e)
-
-        discordError(f"Error copying files for {file.fileInfo.filenameWithoutExt}", e)
-
-import signal
-
-async def processTorrent(torrent: TorrentBase, file: TorrentFileInfo, arr: Arr) -> bool:
+async def downloadTorrent(torrent: TorrentBase, file: TorrentFileInfo) -> bool:
     _print = globals()['print']
 
     def print(*values: object):
         _print(f"[{torrent.__class__.__name__}] [{file.fileInfo.filenameWithoutExt}]", *values)
-        
-    if not torrent.submitTorrent():
+
+    journal = getJournal(file.fileInfo.filePathProcessing)
+    filePathProcessing = file.fileInfo.filePathProcessing
+    start = time.monotonic()
+
+    def recordOutcome(outcome):
+        ProviderStats.forJournal(journal).record(torrent.provider, outcome, time.monotonic() - start)
+
+    journalTorrent = journal.getTorrent(filePathProcessing, torrent.provider)
+    if journalTorrent and journalTorrent.state == STATE_FAILED:
+        print('Already failed before restart')
+        return False
+    elif journalTorrent and journalTorrent.torrentId:
+        torrent.id = journalTorrent.torrentId
+        print(f"Reattached to torrent {torrent.id} ({journalTorrent.state})")
+    elif await torrent.attachExisting():
+        journal.recordTorrent(filePathProcessing, torrent.provider, STATE_COMPLETED, torrent.id)
+        return True
+    elif not await submitTorrent(torrent):
+        recordOutcome(ProviderStats.OUTCOME_MISS if torrent.failIfNotCached and not torrent.skipAvailabilityCheck and not torrent._instantAvailability else ProviderStats.OUTCOME_ERROR)
         return False
+    else:
+        journal.recordTorrent(filePathProcessing, torrent.provider, STATE_SUBMITTED, torrent.id)
 
-    count = 0
+    submitted = time.monotonic()
+    policy = PollingPolicy(blackhole['waitForTorrentTimeout'] if torrent.failIfNotCached else None)
     while True:
-        count += 1
         info = await torrent.getInfo(refresh=True)
         if not info:
+            recordOutcome(ProviderStats.OUTCOME_ERROR)
             return False
 
         status = info['status']
+        torrentStatuses[torrent] = status
         
         print('status:', status)
 
         if status == torrent.STATUS_WAITING_FILES_SELECTION:
             if not await torrent.selectFiles():
-                torrent.delete()
+                await torrent.delete()
+                journal.recordTorrent(filePathProcessing, torrent.provider, STATE_FAILED)
                 return False
+            journal.recordTorrent(filePathProcessing, torrent.provider, STATE_FILES_SELECTED)
         elif status == torrent.STATUS_DOWNLOADING:
             # Send progress to arr
             progress = info['progress']
             print(f"Progress: {progress:.2f}%")
             if torrent.skipAvailabilityCheck and torrent.failIfNotCached:
-                torrent.delete()
+                recordOutcome(ProviderStats.OUTCOME_MISS)
+                await torrent.delete()
+                journal.recordTorrent(filePathProcessing, torrent.provider, STATE_FAILED)
                 return False
-            await asyncio.sleep(1)
         elif status == torrent.STATUS_ERROR:
+            recordOutcome(ProviderStats.OUTCOME_ERROR)
+            journal.recordTorrent(filePathProcessing, torrent.provider, STATE_FAILED)
             return False
         elif status == torrent.STATUS_COMPLETED:
-            existsCount = 0
-            print('Waiting for folders to refresh...')
-
-            while True:
-                existsCount += 1
-                
-                folderPathMountTorrent = await torrent.getTorrentPath()
-                if folderPathMountTorrent:
-                    multiSeasonRegex1 = r'(?<=[\W_][Ss]eason[\W_])[\d][\W_][\d]{1,2}(?=[\W_])'
-                    multiSeasonRegex2 = r'(?<=[\W_][Ss])[\d]{2}[\W_][Ss]?[\d]{2}(?=[\W_])'
-                    multiSeasonRegexCombined = f'{multiSeasonRegex1}|{multiSeasonRegex2}'
-
-                    multiSeasonMatch = re.search(multiSeasonRegexCombined, file.fileInfo.filenameWithoutExt)
-
-                    for root, dirs, files in os.walk(folderPathMountTorrent):
-                        relRoot = os.path.relpath(root, folderPathMountTorrent)
-                        for filename in files:
-                            # Check if the file is accessible
-                            # if not await is_accessible(os.path.join(root, filename)):
-                            #     print(f"Timeout reached when accessing file: {filename}")
-                            #     discordError(f"Timeout reached when accessing file", filename)
-                                # Uncomment the following line to fail the entire torrent if the timeout on any of its files are reached
-                                # fail(torrent)
-                                # return
-                            
-                            if multiSeasonMatch:
-                                seasonMatch = re.search(r'S([\d]{2})E[\d]{2}', filename)
-                                
-                                if seasonMatch:
-                                    season = seasonMatch.group(1)
-                                    seasonShort = season[1:] if season[0] == '0' else season
-
-                                    seasonFolderPathCompleted = re.sub(multiSeasonRegex1, seasonShort, file.fileInfo.folderPathCompleted)
-                                    seasonFolderPathCompleted = re.sub(multiSeasonRegex2, season, seasonFolderPathCompleted)
-
-                                    os.makedirs(os.path.join(seasonFolderPathCompleted, relRoot), exist_ok=True)
-                                    os.symlink(os.path.join(root, filename), os.path.join(seasonFolderPathCompleted, relRoot, filename))
-                                    print('Season Recursive:', f"{os.path.join(seasonFolderPathCompleted, relRoot, filename)} -> {os.path.join(root, filename)}")
-                                    # refreshEndpoint = f"{plex['serverHost']}/library/sections/{plex['serverMovieLibraryId'] if isRadarr else plex['serverTvShowLibraryId']}/refresh?path={urllib.parse.quote_plus(os.path.join(seasonFolderPathCompleted, relRoot))}&X-Plex-Token={plex['serverApiKey']}"
-                                    # cancelRefreshRequest = requests.delete(refreshEndpoint, headers={'Accept': 'application/json'})
-                                    # refreshRequest = requests.get(refreshEndpoint, headers={'Accept': 'application/json'})
-
-                                    continue
-
-
-                            os.makedirs(os.path.join(file.fileInfo.folderPathCompleted, relRoot), exist_ok=True)
-                            os.symlink(os.path.join(root, filename), os.path.join(file.fileInfo.folderPathCompleted, relRoot, filename))
-                            print('Recursive:', f"{os.path.join(file.fileInfo.folderPathCompleted, relRoot, filename)} -> {os.path.join(root, filename)}")
-                            # refreshEndpoint = f"{plex['serverHost']}/library/sections/{plex['serverMovieLibraryId'] if isRadarr else plex['serverTvShowLibraryId']}/refresh?path={urllib.parse.quote_plus(os.path.join(file.fileInfo.folderPathCompleted, relRoot))}&X-Plex-Token={plex['serverApiKey']}"
-                            # cancelRefreshRequest = requests.delete(refreshEndpoint, headers={'Accept': 'application/json'})
-                            # refreshRequest = requests.get(refreshEndpoint, headers={'Accept': 'application/json'})
-                    
-                    print('Refreshed')
-                    discordUpdate(f"Sucessfully processed {file.fileInfo.filenameWithoutExt}", f"Now available for immediate consumption! existsCount: {existsCount}")
-                    
-                    # refreshEndpoint = f"{plex['serverHost']}/library/sections/{plex['serverMovieLibraryId'] if isRadarr else plex['serverTvShowLibraryId']}/refresh?X-Plex-Token={plex['serverApiKey']}"
-                    # cancelRefreshRequest = requests.delete(refreshEndpoint, headers={'Accept': 'application/json'})
-                    # refreshRequest = requests.get(refreshEndpoint, headers={'Accept': 'application/json'})
-                    await refreshArr(arr)
-
-                    # await asyncio.get_running_loop().run_in_executor(None, copyFiles, file, folderPathMountTorrent, arr)
-                    return True
-                
-                if existsCount >= blackhole['rdMountRefreshSeconds'] + 1:
-                    print(f"Torrent folder not found in filesystem: {file.fileInfo.filenameWithoutExt}")
-                    discordError("Torrent folder not found in filesystem", file.fileInfo.filenameWithoutExt)
-
-                    return False
-
-                await asyncio.sleep(1)
+            journal.recordTorrent(filePathProcessing, torrent.provider, STATE_COMPLETED)
+            stageSeconds.observe(torrent.provider, 'completed', value=time.monotonic() - submitted)
+            recordOutcome(ProviderStats.OUTCOME_HIT)
+            return True
     
-        if torrent.failIfNotCached and count >= blackhole['waitForTorrentTimeout']:
+        if policy.expired():
             print(f"Torrent timeout: {file.fileInfo.filenameWithoutExt} - {status}")
             discordError("Torrent timeout", f"{file.fileInfo.filenameWithoutExt} - {status}")
+            recordOutcome(ProviderStats.OUTCOME_ERROR)
+            journal.recordTorrent(filePathProcessing, torrent.provider, STATE_FAILED)
 
             return False
 
+        progress = info.get('progress')
+        await asyncio.sleep(policy.nextInterval(status, progress / torrent.maxProgress if progress is not None else None))
+
+async def warmup(plan: LinkPlan, file: TorrentFileInfo, print):
+    """Read the start and end of the linked media through the mount, and flag any that can't be reached before the Arr imports them."""
+    results = await WarmupPool.get().warm([source for source, target, isSeason in plan.links])
+    getJournal(file.fileInfo.filePathProcessing).recordWarmup(file.fileInfo.filePathProcessing, results)
+
+    unreachable = {path: error for path, error in results.items() if error and error != WarmupPool.SKIPPED}
+    skipped = [path for path, error in results.items() if error == WarmupPool.SKIPPED]
+    if skipped:
+        print(f"Skipped warming {len(skipped)} files, no reader was free in time")
+    if unreachable:
+        message = '\n'.join(f"{os.path.basename(path)}: {error}" for path, error in unreachable.items())
+        print(f"Unreachable through the mount:\n{message}")
+        discordError(f"Unreachable through the mount: {file.fileInfo.filenameWithoutExt}", message)
+    else:
+        print(f"Warmed {len(results) - len(skipped)} files")
+
+# Futures for the torrents being downloaded, keyed by provider and infohash, resolving to the torrent id (or None if it failed).
+# A duplicate (a re-grab, or the same pack dropped in more than one watch path) attaches to the first instead of adding it again.
+inflightTorrents = {}
+
+# The duplicates attached to each torrent, keyed by provider and torrent id, so a race loser that other files link from isn't deleted.
+# A duplicate is released if it doesn't get linked itself, and the whole entry once its owner can no longer be deleted as a race loser.
+torrentAttachments = {}
+
+def releaseAttachments(torrent: TorrentBase):
+    if not torrent.attached:
+        torrentAttachments.pop((torrent.provider, torrent.id), None)
+
+def getInflightKey(torrent: TorrentBase):
+    try:
+        return (torrent.provider, normalizeHash(torrent.getHash()))
+    except Exception:
+        # Malformed files are left for the provider to reject
+        return None
+
+# The stage of every torrent being processed, for the metrics endpoint: the provider's status while downloading, then the local stages
+torrentStatuses = {}
+
+def countTorrentStatuses():
+    counts = {}
+    for torrent, status in list(torrentStatuses.items()):
+        counts[(torrent.provider, status)] = counts.get((torrent.provider, status), 0) + 1
+    return counts
+
+registry.gauge('blackhole_torrents_inflight', 'Torrents being processed, by provider and status', ('provider', 'status'), countTorrentStatuses)
+
+async def processTorrent(torrent: TorrentBase, file: TorrentFileInfo, arr: Arr, race: ProviderRace = None) -> bool:
+    torrentStatuses[torrent] = 'queued'
+    processed = False
+    try:
+        processed = await downloadAndLinkTorrent(torrent, file, arr, race)
+    finally:
+        torrentStatuses.pop(torrent, None)
+        attachments = torrentAttachments.get((torrent.provider, torrent.id))
+        if not processed and attachments:
+            attachments.discard(torrent)
+            if not attachments:
+                del torrentAttachments[(torrent.provider, torrent.id)]
+        if race is None:
+            releaseAttachments(torrent)
+
+    torrentsProcessed.inc(torrent.provider, 'processed' if processed else 'lost' if race and race.winner else 'failed')
+    return processed
+
+async def downloadAndLinkTorrent(torrent: TorrentBase, file: TorrentFileInfo, arr: Arr, race: ProviderRace = None) -> bool:
+    _print = globals()['print']
+
+    def print(*values: object):
+        _print(f"[{torrent.__class__.__name__}] [{file.fileInfo.filenameWithoutExt}]", *values)
+
+    inflightKey = getInflightKey(torrent)
+    if inflightKey in inflightTorrents:
+        print('Waiting for the same torrent already in progress')
+        torrentStatuses[torrent] = 'duplicate'
+        if not torrent.attach(await asyncio.shield(inflightTorrents[inflightKey])):
+            return False
+        torrentAttachments.setdefault((torrent.provider, torrent.id), set()).add(torrent)
+    else:
+        if inflightKey:
+            inflightTorrents[inflightKey] = asyncio.get_running_loop().create_future()
+        downloaded = False
+        try:
+            # Only the debrid side counts against the provider limit, not waiting on the mount or arr
+            async with getProviderScheduler(torrent).admit(print):
+                torrentStatuses[torrent] = 'submitting'
+                downloaded = await downloadTorrent(torrent, file)
+        finally:
+            if inflightKey:
+                inflightTorrents.pop(inflightKey).set_result(torrent.id if downloaded else None)
+
+        if not downloaded:
+            return False
+
+    print('Waiting for folders to refresh...')
+    torrentStatuses[torrent] = 'mount'
+    mountStart = time.monotonic()
+    folderPathMountTorrent = await torrent.getTorrentPath(timeout=blackhole['rdMountRefreshSeconds'])
+    mountSeconds = time.monotonic() - mountStart
+
+    if not folderPathMountTorrent:
+        print(f"Torrent folder not found in filesystem: {file.fileInfo.filenameWithoutExt}")
+        discordError("Torrent folder not found in filesystem", file.fileInfo.filenameWithoutExt)
+
+        return False
+
+    if race and not race.claim(torrent):
+        print('Another provider was linked first')
+        return False
+
+    stageSeconds.observe(torrent.provider, 'visible', value=mountSeconds)
+    visible = time.monotonic()
+    torrentStatuses[torrent] = 'linking'
+    plan = await asyncio.to_thread(buildLinkPlan, folderPathMountTorrent, file.fileInfo.folderPathCompleted, file.fileInfo.filenameWithoutExt)
+    if blackhole['copy']:
+        # The Arr is only refreshed once every file has been copied and verified
+        errors = await CopyPool.get().copy(plan, print)
+        if errors:
+            message = '\n'.join(f"{os.path.basename(path)}: {error}" for path, error in errors.items())
+            print(f"Error copying files:\n{message}")
+            discordError(f"Error copying files for {file.fileInfo.filenameWithoutExt}", message)
+
+            return False
+    else:
+        await asyncio.to_thread(materializeLinkPlan, plan, print)
+    getJournal(file.fileInfo.filePathProcessing).recordJob(file.fileInfo.filePathProcessing, file.fileInfo.filename, STATE_LINKED, plan.rootFolders)
+
+    if blackhole['warmupWorkers'] and not blackhole['copy']:
+        await warmup(plan, file, print)
+    
+    print('Refreshed')
+    discordUpdate(f"Sucessfully processed {file.fileInfo.filenameWithoutExt}", f"Now available for immediate consumption! Waited {mountSeconds:.1f}s for the mount")
+    
+    # refreshEndpoint = f"{plex['serverHost']}/library/sections/{plex['serverMovieLibraryId'] if isRadarr else plex['serverTvShowLibraryId']}/refresh?X-Plex-Token={plex['serverApiKey']}"
+    # cancelRefreshRequest = requests.delete(refreshEndpoint, headers={'Accept': 'application/json'})
+    # refreshRequest = requests.get(refreshEndpoint, headers={'Accept': 'application/json'})
+    torrentStatuses[torrent] = 'importing'
+    if await refreshArr(arr, plan.rootFolders):
+        stageSeconds.observe(torrent.provider, 'imported', value=time.monotonic() - visible)
+
+    return True
+
 async def processFile(file: TorrentFileInfo, arr: Arr, isRadarr):
     try:
         _print = globals()['print']
@@ -278,57 +574,36 @@ async def processFile(file: TorrentFileInfo, arr: Arr, isRadarr):
         def print(*values: object):
             _print(f"[{file.fileInfo.filenameWithoutExt}]", *values)
 
-        from concurrent.futures import ThreadPoolExecutor
-
-        def read_file(path):
-            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-                f.read(1)
-
-        async def is_accessible(path, timeout=10):
-            with ThreadPoolExecutor() as executor:
-                loop = asyncio.get_event_loop()
-                try:
-                    await asyncio.wait_for(loop.run_in_executor(executor, read_file, path), timeout=timeout)
-                    discordUpdate('good')
-                    return True
-                except Exception as e:
-                    discordError('error', e)
-                    return False
-                finally:
-                    executor.shutdown(wait=False)
-
-        time.sleep(.1) # Wait before processing the file in case it isn't fully written yet.
-        os.renames(file.fileInfo.filePath, file.fileInfo.filePathProcessing)
-
-        with open(file.fileInfo.filePathProcessing, 'rb' if file.torrentInfo.isDotTorrentFile else 'r') as f:
-            fileData = f.read()
-            f.seek(0)
-            
-            torrentConstructors = []
-            if realdebrid['enabled']:
-                torrentConstructors.append(RealDebridTorrent if file.torrentInfo.isDotTorrentFile else RealDebridMagnet)
-            if torbox['enabled']:
-                torrentConstructors.append(TorboxTorrent if file.torrentInfo.isDotTorrentFile else TorboxMagnet)
-
-            onlyLargestFile = isRadarr or bool(re.search(r'S[\d]{2}E[\d]{2}(?![\W_][\d]{2}[\W_])', file.fileInfo.filename))
-            if not blackhole['failIfNotCached']:
-                torrents = [constructor(f, fileData, file, blackhole['failIfNotCached'], onlyLargestFile) for constructor in torrentConstructors]
-                results = await asyncio.gather(*(processTorrent(torrent, file, arr) for torrent in torrents))
-                
-                if not any(results):
-                    await asyncio.gather(*(fail(torrent, arr, isRadarr) for torrent in torrents))
-            else:
-                for i, constructor in enumerate(torrentConstructors):
-                    isLast = (i == len(torrentConstructors) - 1)
-                    torrent = constructor(f, fileData, file, blackhole['failIfNotCached'], onlyLargestFile)
-
-                    if await processTorrent(torrent, file, arr):
-                        break
-                    elif isLast:
-                        await fail(torrent, arr, isRadarr)
+        journal = getJournal(file.fileInfo.filePathProcessing)
+        filePathProcessing = file.fileInfo.filePathProcessing
+        if file.isResumed:
+            job = journal.getJob(filePathProcessing)
+            print(f"Resuming from {job.state if job else STATE_RENAMED}")
+        else:
+            await asyncio.sleep(.1) # Wait before processing the file in case it isn't fully written yet.
+            try:
+                os.renames(file.fileInfo.filePath, filePathProcessing)
+            except FileNotFoundError:
+                if os.path.exists(file.fileInfo.filePath):
+                    raise
+                # Another blackhole process (e.g. a concurrent on_created run) moved it first
+                print('Already picked up by another process')
+                return
+            journal.recordJob(filePathProcessing, file.fileInfo.filename, STATE_RENAMED)
+            job = None
+
+        if job and job.state == STATE_LINKED:
+            # Symlinks were already created before the restart, only the Arr import is left
+            await refreshArr(arr, job.folders)
+        elif job and job.state == STATE_FAILED:
+            print('Already failed before restart')
+        else:
+            await processTorrents(file, arr, isRadarr)
 
-            os.remove(file.fileInfo.filePathProcessing)
-    except:
+        os.remove(filePathProcessing)
+        journal.remove(filePathProcessing)
+    except Exception:
+        # Cancellation (shutdown) propagates and leaves the journal as is, so the file is resumed on the next start
         e = traceback.format_exc()
 
         print(f"Error processing {file.fileInfo.filenameWithoutExt}")
@@ -336,6 +611,47 @@ async def processFile(file: TorrentFileInfo, arr: Arr, isRadarr):
 
         discordError(f"Error processing {file.fileInfo.filenameWithoutExt}", e)
 
+        # Recorded as failed so the next start clears it instead of retrying it
+        if os.path.exists(file.fileInfo.filePathProcessing):
+            try:
+                getJournal(file.fileInfo.filePathProcessing).recordJob(file.fileInfo.filePathProcessing, file.fileInfo.filename, STATE_FAILED)
+            except Exception as journalError:
+                print(f"Error recording the failure: {journalError}")
+
+async def processTorrents(file: TorrentFileInfo, arr: Arr, isRadarr):
+    with open(file.fileInfo.filePathProcessing, 'rb' if file.torrentInfo.isDotTorrentFile else 'r') as f:
+        fileData = f.read()
+        f.seek(0)
+        
+        torrentConstructors = []
+        if realdebrid['enabled']:
+            torrentConstructors.append(RealDebridTorrent if file.torrentInfo.isDotTorrentFile else RealDebridMagnet)
+        if torbox['enabled']:
+            torrentConstructors.append(TorboxTorrent if file.torrentInfo.isDotTorrentFile else TorboxMagnet)
+
+        onlyLargestFile = isRadarr or bool(re.search(r'S[\d]{2}E[\d]{2}(?![\W_][\d]{2}[\W_])', file.fileInfo.filename))
+        if not blackhole['failIfNotCached']:
+            torrents = [constructor(f, fileData, file, blackhole['failIfNotCached'], onlyLargestFile) for constructor in torrentConstructors]
+            
+            if not await ProviderRace(file, arr).run(torrents):
+                await asyncio.gather(*(fail(torrent, arr, isRadarr) for torrent in torrents))
+                getJournal(file.fileInfo.filePathProcessing).recordJob(file.fileInfo.filePathProcessing, file.fileInfo.filename, STATE_FAILED)
+        else:
+            orderedConstructors = ProviderStats.forJournal(getJournal(file.fileInfo.filePathProcessing)).order(torrentConstructors)
+            if orderedConstructors != torrentConstructors:
+                print(f"[{file.fileInfo.filenameWithoutExt}] Trying {', '.join(constructor.provider for constructor in orderedConstructors)} in order of expected time")
+            torrentConstructors = orderedConstructors
+
+            for i, constructor in enumerate(torrentConstructors):
+                isLast = (i == len(torrentConstructors) - 1)
+                torrent = constructor(f, fileData, file, blackhole['failIfNotCached'], onlyLargestFile)
+
+                if await processTorrent(torrent, file, arr):
+                    break
+                elif isLast:
+                    await fail(torrent, arr, isRadarr)
+                    getJournal(file.fileInfo.filePathProcessing).recordJob(file.fileInfo.filePathProcessing, file.fileInfo.filename, STATE_FAILED)
+
 async def fail(torrent: TorrentBase, arr: Arr, isRadarr):
     _print = globals()['print']
 
@@ -344,9 +660,7 @@ async def fail(torrent: TorrentBase, arr: Arr, isRadarr):
 
     print(f"Failing")
     
-    torrentHash = torrent.getHash()
-    history = await asyncio.to_thread(arr.getHistory, blackhole['historyPageSize'], includeGrandchildDetails=True)
-    items = [item for item in history if (item.torrentInfoHash and item.torrentInfoHash.casefold() == torrentHash.casefold()) or cleanFileName(item.sourceTitle.casefold()) == torrent.file.fileInfo.filenameWithoutExt.casefold()]
+    items = await HistoryIndex.forArr(arr, blackhole['historyPageSize']).find(torrent.getHash(), torrent.file.fileInfo.filenameWithoutExt)
     
     if not items:
         message = "No history items found to mark as failed. Arr will not attempt to grab an alternative."
@@ -371,35 +685,183 @@ async def fail(torrent: TorrentBase, arr: Arr, isRadarr):
 
     print(f"Failed")
     
-def getFiles(isRadarr):
-    print('getFiles')
-    files = (TorrentFileInfo(filename, isRadarr) for filename in os.listdir(getPath(isRadarr)) if filename not in ['processing', 'completed'])
-    return [file for file in files if file.torrentInfo.isTorrentOrMagnet]
+class DirectoryScanner():
+    """
+    Lists a watch path for torrent and magnet files, returning each file once.
+    Files are claimed by name and inode, and a claim is released once its name stops being listed (i.e. after the rename into processing),
+    so a file is never handed out twice while it waits for its rename, but a new file dropped under the same name later still is.
+    """
+    def __init__(self, isRadarr, watchPath=None) -> None:
+        self.isRadarr = isRadarr
+        self.watchPath = watchPath
+        self.path = getPath(isRadarr, watchPath=watchPath)
+        self.claimed = set()
+        self.maxNameBytes = None
+
+    def scan(self):
+        """:return: A TorrentFileInfo for each file not returned by an earlier scan."""
+        if self.maxNameBytes is None:
+            self.maxNameBytes = getMaxNameBytes(self.path)
+
+        listed = set()
+        files = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.name.casefold().endswith(('.torrent', '.magnet')):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    key = (entry.name, entry.inode())
+                except OSError:
+                    # Renamed away between listing and checking it
+                    continue
+
+                listed.add(key)
+                if key not in self.claimed:
+                    self.claimed.add(key)
+                    files.append(TorrentFileInfo(entry.name, self.isRadarr, watchPath=self.watchPath, maxNameBytes=self.maxNameBytes))
+
+        self.claimed &= listed
+        return files
+
+def getProcessingFiles(isRadarr, watchPath=None):
+    """Files left in the processing folder by a previous run that stopped before finishing them."""
+    processingPath = os.path.join(getPath(isRadarr, watchPath=watchPath), 'processing')
+    if not os.path.isdir(processingPath):
+        return []
+
+    files = []
+    for processingName in os.listdir(processingPath):
+        if processingName.startswith('.'):
+            continue
+        filePathProcessing = os.path.join(processingPath, processingName)
+        job = getJournal(filePathProcessing).getJob(filePathProcessing)
+        if not job:
+            # Left behind by an error before the journal existed, resubmitting it could fail a release the Arr has long since replaced
+            print(f"Not resuming {processingName}, it has no journal entry")
+            continue
+        file = TorrentFileInfo(job.filename, isRadarr, filePathProcessing, watchPath)
+        if file.torrentInfo.isTorrentOrMagnet:
+            files.append(file)
+    return files
+
+async def prefetchTorboxAvailability(files):
+    def getHashes():
+        hashes = []
+        for file in files:
+            filePath = file.fileInfo.filePathProcessing if file.isResumed else file.fileInfo.filePath
+            try:
+                with open(filePath, 'rb' if file.torrentInfo.isDotTorrentFile else 'r') as f:
+                    torrent = (TorboxTorrent if file.torrentInfo.isDotTorrentFile else TorboxMagnet)(f, f.read(), file, True, False)
+                    hashes.append(torrent.getHash())
+            except Exception:
+                # Moved to processing by a worker already, or malformed, either way it's checked on its own
+                pass
+        return hashes
+
+    TorboxCacheChecker.forAccount(torbox['apiKey']).prefetch(await asyncio.to_thread(getHashes))
+
+ingestors = []
+
+registry.gauge('blackhole_queue_depth', 'Files waiting for a worker', ('watch_path',), lambda: {(ingestor.watchPath,): ingestor.queue.qsize() for ingestor in ingestors})
+registry.gauge('blackhole_files_processing', 'Files being processed by a worker', ('watch_path',), lambda: {(ingestor.watchPath,): len(ingestor.queuedPaths) - ingestor.queue.qsize() for ingestor in ingestors})
+
+class Ingestor():
+    """
+    Feeds the torrent and magnet files of a watch path through a queue consumed by a fixed pool of worker tasks.
+    Must be constructed inside the event loop that will run it.
+    """
+    def __init__(self, isRadarr, workers=None, instance=None) -> None:
+        """:param instance: One of blackholeInstances, defaults to the first."""
+        instance = instance or blackholeInstances[0]
+        self.isRadarr = isRadarr
+        self.watchPath = instance['radarrPath'] if isRadarr else instance['sonarrPath']
+        self.arr = Radarr(instance['radarrHost'], instance['radarrApiKey']) if isRadarr else Sonarr(instance['sonarrHost'], instance['sonarrApiKey'])
+        self.workers = workers or blackhole['workers']
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Processing paths of the files queued or being processed
+        self.queuedPaths = set()
+        self.scanner = DirectoryScanner(isRadarr, self.watchPath)
+        self.scanScheduled = False
+        ingestors.append(self)
+
+    def notifyThreadsafe(self):
+        """Request a scan of the watch path. Safe to call from the watchdog observer thread."""
+        self.loop.call_soon_threadsafe(self.requestScan)
+
+    def requestScan(self):
+        # Coalesce bursts of events (e.g. a season's worth of episodes) into a single scan
+        if not self.scanScheduled:
+            self.scanScheduled = True
+            self.loop.call_soon(self.scan)
+
+    def scan(self):
+        self.scanScheduled = False
+        queued = []
+        for file in self.scanner.scan():
+            self.queuedPaths.add(file.fileInfo.filePathProcessing)
+            self.queue.put_nowait(file)
+            queued.append(file)
+        self.prefetchAvailability(queued)
+
+    async def worker(self):
+        while True:
+            file = await self.queue.get()
+            try:
+                await processFile(file, self.arr, self.isRadarr)
+            finally:
+                self.queuedPaths.discard(file.fileInfo.filePathProcessing)
+                self.queue.task_done()
+                # A file with the same name may have been dropped while this one was processing
+                self.requestScan()
+
+    def resume(self):
+        queued = []
+        for file in getProcessingFiles(self.isRadarr, self.watchPath):
+            self.queuedPaths.add(file.fileInfo.filePathProcessing)
+            self.queue.put_nowait(file)
+            queued.append(file)
+        self.prefetchAvailability(queued)
+
+    def prefetchAvailability(self, files):
+        """
+        Start the TorBox cache checks of newly queued files, so the whole queue is checked in a few batched requests
+        and files that aren't cached fail as soon as a worker reaches them, without waiting on a check of their own.
+        """
+        if files and torbox['enabled'] and blackhole['failIfNotCached']:
+            asyncio.create_task(prefetchTorboxAvailability(files))
+
+    async def run(self, drain=False):
+        """Process files forever, or until the queue is empty if drain is set."""
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        try:
+            self.resume()
+            self.scan()
+            if not self.queuedPaths:
+                print('No torrent files found')
+
+            if drain:
+                await self.queue.join()
+            else:
+                await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
 
-async def on_created(isRadarr):
+def getIngestors():
+    """One Ingestor per watch path of every instance, all sharing this process's debrid pollers and connection pool."""
+    return [Ingestor(isRadarr, instance=instance) for instance in blackholeInstances for isRadarr in (True, False)]
+
+async def on_created(isRadarr, instanceName=None):
     print("Enter 'on_created'")
     try:
         print('radarr/sonarr:', 'radarr' if isRadarr else 'sonarr')
 
-        if isRadarr:
-            arr = Radarr()
-        else:
-            arr = Sonarr()
-
-        futures: list[asyncio.Future] = []
-        firstGo = True
-        
-        # Consider switching to a queue
-        while firstGo or not all(future.done() for future in futures):
-            files = getFiles(isRadarr)
-            if files:
-                futures.append(asyncio.gather(*(processFile(file, arr, isRadarr) for file in files)))
-            elif firstGo:
-                print('No torrent files found')
-            firstGo = False
-            await asyncio.sleep(1)
-
-        await asyncio.gather(*futures)
+        instance = next(instance for instance in blackholeInstances if instance['name'] == instanceName)
+        await Ingestor(isRadarr, instance=instance).run(drain=True)
+        await closeAsyncClient()
     except:
         e = traceback.format_exc()
 
@@ -410,4 +872,4 @@ async def on_created(isRadarr):
     print("Exit 'on_created'")
 
 if __name__ == "__main__":
-    asyncio.run(on_created(isRadarr=sys.argv[1] == 'radarr'))
+    asyncio.run(on_created(isRadarr=sys.argv[1] == 'radarr', instanceName=sys.argv[2].lower() if len(sys.argv) > 2 else None))
@@ -1,47 +1,46 @@
 import asyncio
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from blackhole import on_created, getPath
+from blackhole import Ingestor, getIngestors, getPath
+from shared.requests import closeAsyncClient
+from shared.metrics import startMetricsServer
+from shared.shared import blackhole
 
 class BlackholeHandler(FileSystemEventHandler):
-    def __init__(self, is_radarr):
+    def __init__(self, ingestor: Ingestor):
         super().__init__()
-        self.is_radarr = is_radarr
-        self.path_name = getPath(is_radarr, create=True)
+        self.ingestor = ingestor
+        self.path_name = getPath(ingestor.isRadarr, create=True, watchPath=ingestor.watchPath)
 
     def on_created(self, event):
         if not event.is_directory and event.src_path.lower().endswith((".torrent", ".magnet")):
-            asyncio.run(on_created(self.is_radarr))
+            self.ingestor.notifyThreadsafe()
 
     async def on_run(self):
-        await on_created(self.is_radarr)
+        await self.ingestor.run()
 
 async def main():
         print("Watching blackhole")
 
-        radarr_handler = BlackholeHandler(is_radarr=True)
-        sonarr_handler = BlackholeHandler(is_radarr=False)
+        if blackhole['metricsPort']:
+            startMetricsServer(blackhole['metricsPort'])
 
-        radarr_observer = Observer()
-        radarr_observer.schedule(radarr_handler, radarr_handler.path_name)
+        handlers = [BlackholeHandler(ingestor) for ingestor in getIngestors()]
 
-        sonarr_observer = Observer()
-        sonarr_observer.schedule(sonarr_handler, sonarr_handler.path_name)
+        observer = Observer()
+        for handler in handlers:
+            observer.schedule(handler, handler.path_name)
 
         try:
-            radarr_observer.start()
-            sonarr_observer.start()
+            observer.start()
             
-            await asyncio.gather(
-                radarr_handler.on_run(),
-                sonarr_handler.on_run()
-            )
+            await asyncio.gather(*(handler.on_run() for handler in handlers))
         except KeyboardInterrupt:
-            radarr_observer.stop()
-            sonarr_observer.stop()
+            observer.stop()
+        finally:
+            await closeAsyncClient()
 
-        radarr_observer.join()
-        sonarr_observer.join()
+        observer.join()
 
 
 if __name__ == "__main__":
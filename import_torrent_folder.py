@@ -1,7 +1,7 @@
 import os
-import re
 import argparse
 from shared.shared import blackhole, realdebrid
+from shared.links import buildLinkPlan, printLinkPlan, materializeLinkPlan
 
 parentDirectory = realdebrid['mountTorrentsPath']
 
@@ -19,42 +19,11 @@ def process_directory(directory, completedParentDirectory, custom_regex=None, dr
     fullDirectory = os.path.join(parentDirectory, directory)
     completedFullDirectory = os.path.join(completedParentDirectory, directory)
 
-    multiSeasonRegex1 = r'(?<=[\W_][Ss]eason[\W_])[\d][\W_][\d]{1,2}(?=[\W_])'
-    multiSeasonRegex2 = r'(?<=[\W_][Ss])[\d]{2}[\W_][Ss]?[\d]{2}(?=[\W_])'
-    multiSeasonRegexCombined = f'{multiSeasonRegex1}|{multiSeasonRegex2}'
-    if custom_regex:
-        multiSeasonRegexCombined += f'|{custom_regex}'
-
-    multiSeasonMatch = re.search(multiSeasonRegexCombined, directory)
-
-    for root, dirs, files in os.walk(fullDirectory):
-        relRoot = os.path.relpath(root, fullDirectory)
-        for filename in files:
-            if multiSeasonMatch:
-                seasonMatch = re.search(r'S([\d]{2})E[\d]{2}', filename)
-                
-                if seasonMatch:
-                    season = seasonMatch.group(1)
-                    seasonShort = season[1:] if season[0] == '0' else season
-
-                    seasonDirectory = re.sub(multiSeasonRegex1, seasonShort, directory)
-                    seasonDirectory = re.sub(multiSeasonRegex2, season, seasonDirectory)
-                    if custom_regex:
-                        seasonDirectory = re.sub(custom_regex, f' Season {seasonShort} S{season} ', seasonDirectory)
-
-                    completedSeasonFullDirectory = os.path.join(completedParentDirectory, seasonDirectory)
-
-                    if not dry_run:
-                        os.makedirs(os.path.join(completedSeasonFullDirectory, relRoot), exist_ok=True)
-                        os.symlink(os.path.join(root, filename), os.path.join(completedSeasonFullDirectory, relRoot, filename))
-                    print('Season Recursive:', f"{os.path.join(completedSeasonFullDirectory, relRoot, filename)} -> {os.path.join(root, filename)}")
-
-                    continue
-
-            if not dry_run:
-                os.makedirs(os.path.join(completedFullDirectory, relRoot), exist_ok=True)
-                os.symlink(os.path.join(root, filename), os.path.join(completedFullDirectory, relRoot, filename))
-            print('Recursive:', f"{os.path.join(completedFullDirectory, relRoot, filename)} -> {os.path.join(root, filename)}")
+    plan = buildLinkPlan(fullDirectory, completedFullDirectory, directory, custom_regex)
+    if dry_run:
+        printLinkPlan(plan)
+    else:
+        materializeLinkPlan(plan)
 
 def process(directory, completedParentDirectory, custom_regex, dry_run=False, no_confirm=False):
     if directory:
@@ -4,9 +4,11 @@ import asyncio
 import time
 import traceback
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from shared.debrid import validateRealdebridMountTorrentsPath, validateTorboxMountTorrentsPath
-from shared.arr import Sonarr, Radarr
+from shared.arr import Sonarr, Radarr, FileCatalog
+from shared.requests import RateLimiter
 from shared.discord import discordUpdate as _discordUpdate, discordError as _discordError
 from shared.shared import repair, realdebrid, torbox, intersperse, ensureTuple
 from datetime import datetime
@@ -76,6 +78,8 @@ parser.add_argument('--run-interval', type=str, default=repair['runInterval'], h
 parser.add_argument('--mode', type=str, choices=['symlink', 'file'], default='symlink', help='Choose repair mode: `symlink` or `file`. `symlink` to repair broken symlinks and `file` to repair missing files.')
 parser.add_argument('--season-packs', action='store_true', help='Upgrade to season-packs when a non-season-pack is found. Only applicable in symlink mode.')
 parser.add_argument('--include-unmonitored', action='store_true', help='Include unmonitored media in the repair process')
+parser.add_argument('--workers', type=int, default=repair['workers'], help='Number of media items to scan at once. Repairs still happen one at a time, in order.')
+parser.add_argument('--rate-limit', type=int, default=repair['rateLimit'], help='Maximum requests per second to each Sonarr/Radarr host, 0 for unlimited.')
 args = parser.parse_args()
 
 _print = print
@@ -116,6 +120,63 @@ except Exception as e:
     print(f"Invalid interval format for run interval: {args.run_interval}")
     exit(1)
 
+def scanMedia(arr, media, catalog):
+    """
+    Fetch and check every child of a media item. Runs in the scan workers, so it only reads.
+
+    :return: A (childId, childItems, brokenItems, parentFolders, mediaDescriptor) tuple per child, or the traceback if scanning failed.
+    """
+    try:
+        getItems = lambda media, childId: catalog.getFiles(media=media, childId=childId) if args.mode == 'symlink' else arr.getHistory(media=media, childId=childId, includeGrandchildDetails=True)
+        childrenIds = media.childrenIds if args.include_unmonitored else media.monitoredChildrenIds
+
+        scans = []
+        for childId in childrenIds:
+            brokenItems = []
+            childItems = list(getItems(media=media, childId=childId))
+            parentFolders = set()
+            mediaDescriptor = f"(Season {childId})" if isinstance(arr, Sonarr) else f"(Movie ID: {childId})"
+
+            for item in childItems:
+                if args.mode == 'symlink':
+                    fullPath = item.path
+                    if os.path.islink(fullPath):
+                        destinationPath = os.readlink(fullPath)
+                        parentFolders.add(os.path.dirname(os.path.realpath(fullPath)))
+                        if ((realdebrid['enabled'] and destinationPath.startswith(realdebrid['mountTorrentsPath']) and not os.path.exists(destinationPath)) or 
+                           (torbox['enabled'] and destinationPath.startswith(torbox['mountTorrentsPath']) and not os.path.exists(os.path.realpath(fullPath)))):
+                            brokenItems.append(os.path.realpath(fullPath))
+                else:  # file mode
+                    if item.reason == 'MissingFromDisk' and item.parentId not in media.fullyAvailableChildrenIds:
+                        brokenItems.append(item.sourceTitle)
+
+            scans.append((childId, childItems, brokenItems, parentFolders, mediaDescriptor))
+        return scans
+    except Exception:
+        return traceback.format_exc()
+
+def scanAhead(executor, mediaItems, catalogs, window):
+    """
+    Scan media items in order, at most window items ahead of the one being repaired,
+    so a scan is never much older than the repair acting on it.
+
+    :return: A generator of (arr, media, scanMedia result).
+    """
+    mediaItems = iter(mediaItems)
+    pending = deque()
+
+    def submitNext():
+        for arr, media in mediaItems:
+            pending.append((arr, media, executor.submit(scanMedia, arr, media, catalogs[arr])))
+            return
+
+    for _ in range(window):
+        submitNext()
+    while pending:
+        arr, media, future = pending.popleft()
+        submitNext()
+        yield arr, media, future.result()
+
 def main():
     printSection("Starting Repair Process")
     if args.dry_run:
@@ -129,6 +190,8 @@ def main():
     print("Collecting media from Sonarr and Radarr...")
     sonarr = Sonarr()
     radarr = Radarr()
+    RateLimiter.setLimit(sonarr.host, args.rate_limit)
+    RateLimiter.setLimit(radarr.host, args.rate_limit)
     sonarrMedia = [(sonarr, media) for media in sonarr.getAll() if args.include_unmonitored or media.anyMonitoredChildren]
     radarrMedia = [(radarr, media) for media in radarr.getAll() if args.include_unmonitored or media.anyMonitoredChildren]
     print(f"✓ Collected {len(sonarrMedia)} Sonarr items and {len(radarrMedia)} Radarr items", level="SUCCESS")
@@ -137,36 +200,41 @@ def main():
     fixedBrokenItems = False
     seasonPackPendingMessages = defaultdict(lambda: defaultdict(list))
     
-    for arr, media in intersperse(sonarrMedia, radarrMedia):
+    # Media is scanned by the workers just ahead of the repairs, which are made here one at a time and in order
+    mediaItems = list(intersperse(sonarrMedia, radarrMedia))
+    catalogs = {sonarr: FileCatalog(sonarr), radarr: FileCatalog(radarr)}
+    if args.mode == 'symlink':
+        print("Collecting files from Sonarr and Radarr...")
+        for arr, arrMedia in ((sonarr, sonarrMedia), (radarr, radarrMedia)):
+            try:
+                catalogs[arr].prefetch([media for _, media in arrMedia], max(args.workers, 1))
+            except Exception:
+                # Nothing was stored, so every media item is fetched on its own while scanning
+                e = traceback.format_exc()
+                error_msg = f"An error occurred while collecting {arr.__class__.__name__} files: "
+                print(error_msg + e)
+                discordError(error_msg, e)
+        print()
+
+    workers = max(args.workers, 1)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan')
+
+    for arr, media, childScans in scanAhead(executor, mediaItems, catalogs, workers):
+        if isinstance(childScans, str):
+            error_msg = f"An error occurred while processing {media.title}: "
+            print(error_msg + childScans)
+            discordError(error_msg, childScans)
+            continue
+
         try:
             if unsafe():
                 error_msg = "One or more debrid services are not working properly. Aborting repair."
                 print(error_msg, level="ERROR")
                 discordError(error_msg)
+                executor.shutdown(wait=False, cancel_futures=True)
                 return
 
-            getItems = lambda media, childId: arr.getFiles(media=media, childId=childId) if args.mode == 'symlink' else arr.getHistory(media=media, childId=childId, includeGrandchildDetails=True)
-            childrenIds = media.childrenIds if args.include_unmonitored else media.monitoredChildrenIds
-
-            for childId in childrenIds:
-                brokenItems = []
-                childItems = list(getItems(media=media, childId=childId))
-                parentFolders = set()
-                mediaDescriptor = f"(Season {childId})" if isinstance(arr, Sonarr) else f"(Movie ID: {childId})"
-
-                for item in childItems:
-                    if args.mode == 'symlink':
-                        fullPath = item.path
-                        if os.path.islink(fullPath):
-                            destinationPath = os.readlink(fullPath)
-                            parentFolders.add(os.path.dirname(os.path.realpath(fullPath)))
-                            if ((realdebrid['enabled'] and destinationPath.startswith(realdebrid['mountTorrentsPath']) and not os.path.exists(destinationPath)) or 
-                               (torbox['enabled'] and destinationPath.startswith(torbox['mountTorrentsPath']) and not os.path.exists(os.path.realpath(fullPath)))):
-                                brokenItems.append(os.path.realpath(fullPath))
-                    else:  # file mode
-                        if item.reason == 'MissingFromDisk' and item.parentId not in media.fullyAvailableChildrenIds:
-                            brokenItems.append(item.sourceTitle)
-
+            for childId, childItems, brokenItems, parentFolders, mediaDescriptor in childScans:
                 if brokenItems:
                     fixedBrokenItems = True
                     msg = f"Repairing {media.title} {mediaDescriptor}"
@@ -175,6 +243,22 @@ def main():
                     print(msg2)
                     [print(item) for item in brokenItems]
                     if not args.dry_run and (args.no_confirm or input("Do you want to delete and re-grab? (y/n): ").lower() == 'y'):
+                        if args.mode == 'symlink':
+                            # The scan may predate a prompt or a repair interval, so check the mount and the files again before deleting anything
+                            if unsafe():
+                                error_msg = "One or more debrid services are not working properly. Aborting repair."
+                                print(error_msg, level="ERROR")
+                                discordError(error_msg)
+                                executor.shutdown(wait=False, cancel_futures=True)
+                                return
+                            brokenItems = [item for item in brokenItems if not os.path.exists(item)]
+                            if not brokenItems:
+                                print("The broken items are reachable again, skipping")
+                                print()
+                                continue
+                            # The catalog's file IDs date from the start of the pass
+                            childItems = list(arr.getFiles(media=media, childId=childId))
+
                         discordUpdate(msg, msg2)
                         if args.mode == 'symlink':
                             print("Deleting files:")
@@ -219,6 +303,8 @@ def main():
             error_msg = f"An error occurred while processing {media.title}: "
             print(error_msg + e)
             discordError(error_msg, e)
+
+    executor.shutdown()
             
     if not args.season_packs and seasonPackPendingMessages:
         printSection("Non-season-pack folders")
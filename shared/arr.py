@@ -1,8 +1,12 @@
+import re
+import asyncio
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import Type, List
+from datetime import datetime, timedelta, timezone
 import requests
 from shared.shared import sonarr, radarr, checkRequiredEnvs
-from shared.requests import retryRequest
+from shared.requests import retryRequest, RateLimiter
 
 def validateSonarrHost():
     url = f"{sonarr['host']}/login"
@@ -208,6 +212,12 @@ class MediaHistory(ABC):
     def sourceTitle(self):
         return self.json['sourceTitle']
 
+    @property
+    def date(self):
+        """When the event happened, in UTC."""
+        # The Arrs send UTC with a varying number of fractional digits, which older Pythons can't parse, so only the seconds are kept
+        return datetime.strptime(self.json['date'][:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+
     @property
     def torrentInfoHash(self):
         return self.json['data'].get('torrentInfoHash')
@@ -217,6 +227,15 @@ class MediaHistory(ABC):
         """Get the release type from the history item data."""
         return self.json['data'].get('releaseType')
 
+    @property
+    def droppedPath(self):
+        """Get the path the file was imported from, for import events."""
+        return self.json['data'].get('droppedPath')
+
+    @property
+    def isDownloadFolderImportedEvent(self):
+        return self.eventType == 'downloadFolderImported'
+
     @property
     @abstractmethod
     def parentId(self):
@@ -264,6 +283,9 @@ class EpisodeHistory(MediaHistory):
         return self.eventType == 'episodeFileDeleted'
     
 class Arr(ABC):
+    # Same value in Sonarr's and Radarr's history event type enums
+    downloadFolderImportedEventType = 3
+
     def __init__(self, host: str, apiKey: str, endpoint: str, fileEndpoint: str, childIdName: str, childName: str, grandchildName: str, constructor: Type[Media], fileConstructor: Type[MediaFile], historyConstructor: Type[MediaHistory]) -> None:
         self.host = host
         self.apiKey = apiKey
@@ -276,51 +298,82 @@ class Arr(ABC):
         self.fileConstructor = fileConstructor
         self.historyConstructor = historyConstructor
 
+    def _retryRequest(self, requestFunc):
+        """retryRequest, with every attempt held to the host's rate limit if one is set."""
+        rateLimiter = RateLimiter.forHost(self.host)
+        if rateLimiter is None:
+            return retryRequest(requestFunc)
+
+        def limitedRequestFunc():
+            rateLimiter.wait()
+            return requestFunc()
+        return retryRequest(limitedRequestFunc)
+
     def get(self, id: int):
-        response = retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.endpoint}/{id}?apiKey={self.apiKey}"))
+        response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.endpoint}/{id}?apiKey={self.apiKey}"))
         return self.constructor(response.json())
 
     def getAll(self):
-        response = retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.endpoint}?apiKey={self.apiKey}"))
+        response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.endpoint}?apiKey={self.apiKey}"))
         return map(self.constructor, response.json())
 
     def put(self, media: Media):
-        retryRequest(lambda: requests.put(f"{self.host}/api/v3/{self.endpoint}/{media.id}?apiKey={self.apiKey}&moveFiles=true", json=media.json))
+        self._retryRequest(lambda: requests.put(f"{self.host}/api/v3/{self.endpoint}/{media.id}?apiKey={self.apiKey}&moveFiles=true", json=media.json))
 
     def getFiles(self, media: Media, childId: int = None):
-        response = retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.fileEndpoint}?apiKey={self.apiKey}&{self.endpoint}Id={media.id}"))
+        response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.fileEndpoint}?apiKey={self.apiKey}&{self.endpoint}Id={media.id}"))
         return map(self.fileConstructor, response.json())
 
+    def getFilesByMedia(self, media: List[Media], workers: int = 8):
+        """
+        Get the files of many media items, fetching workers of them at a time.
+
+        :return: A dict of each media item's ID to its files. Media items whose files couldn't be fetched are left out.
+        """
+        def getMediaFiles(media):
+            try:
+                return list(self.getFiles(media))
+            except Exception as e:
+                print(f"Error getting the files of {media.title}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='files') as executor:
+            files = executor.map(getMediaFiles, media)
+            return {media.id: mediaFiles for media, mediaFiles in zip(media, files) if mediaFiles is not None}
+
     def deleteFiles(self, files: List[MediaFile]):
         fileIds = [file.id for file in files]
-        response = retryRequest(lambda: requests.delete(f"{self.host}/api/v3/{self.fileEndpoint}/bulk?apiKey={self.apiKey}", json={f"{self.fileEndpoint}ids": fileIds}))
+        response = self._retryRequest(lambda: requests.delete(f"{self.host}/api/v3/{self.fileEndpoint}/bulk?apiKey={self.apiKey}", json={f"{self.fileEndpoint}ids": fileIds}))
         
         return response.json()
 
-    def getHistory(self, pageSize: int=None, includeGrandchildDetails: bool=False, media: Media=None, childId: int=None):
+    def getHistory(self, pageSize: int=None, includeGrandchildDetails: bool=False, media: Media=None, childId: int=None, eventType: int=None, page: int=None, sortKey: str=None, sortDirection: str=None):
         endpoint = f"/{self.endpoint}" if media else ''
         pageSizeParam = f"pageSize={pageSize}&" if pageSize else ''
+        pageParam = f"page={page}&" if page else ''
+        sortParam = f"sortKey={sortKey}&sortDirection={sortDirection or 'descending'}&" if sortKey else ''
+        eventTypeParam = f"eventType={eventType}&" if eventType is not None else ''
         includeGrandchildDetailsParam = f"include{self.grandchildName}=true&" if includeGrandchildDetails else ''
         idParam = f"{self.endpoint}Id={media.id}&" if media else ''
         childIdParam = f"{self.childIdName}={childId}&" if media and childId != None and childId != media.id else ''
-        response = retryRequest(lambda: requests.get(f"{self.host}/api/v3/history{endpoint}?{pageSizeParam}{includeGrandchildDetailsParam}{idParam}{childIdParam}apiKey={self.apiKey}"))
+        response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/history{endpoint}?{pageSizeParam}{pageParam}{sortParam}{eventTypeParam}{includeGrandchildDetailsParam}{idParam}{childIdParam}apiKey={self.apiKey}"))
         
         history = response.json()
 
         return map(self.historyConstructor, history['records'] if isinstance(history, dict) else history)
     
     def failHistoryItem(self, historyId: int):
-        retryRequest(lambda: requests.post(f"{self.host}/api/v3/history/failed/{historyId}?apiKey={self.apiKey}"))
+        self._retryRequest(lambda: requests.post(f"{self.host}/api/v3/history/failed/{historyId}?apiKey={self.apiKey}"))
 
     def refreshMonitoredDownloads(self):
-        retryRequest(lambda: requests.post(f"{self.host}/api/v3/command?apiKey={self.apiKey}", json={'name': 'RefreshMonitoredDownloads'}, headers={'Content-Type': 'application/json'}))
+        self._retryRequest(lambda: requests.post(f"{self.host}/api/v3/command?apiKey={self.apiKey}", json={'name': 'RefreshMonitoredDownloads'}, headers={'Content-Type': 'application/json'}))
 
     def interactiveSearch(self, media: Media, childId: int):
-        response = retryRequest(lambda: requests.get(f"{self.host}/api/v3/release?apiKey={self.apiKey}&{self.endpoint}Id={media.id}{f'&{self.childIdName}={childId}' if childId != media.id else ''}"))
+        response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/release?apiKey={self.apiKey}&{self.endpoint}Id={media.id}{f'&{self.childIdName}={childId}' if childId != media.id else ''}"))
         return response.json()
 
     def automaticSearch(self, media: Media, childId: int):
-        response = retryRequest(lambda: requests.post(
+        response = self._retryRequest(lambda: requests.post(
             f"{self.host}/api/v3/command?apiKey={self.apiKey}", 
             json=self._automaticSearchJson(media, childId), 
         ))
@@ -330,7 +383,7 @@ class Arr(ABC):
         pass
     
     def getCommandResults(self, commandId: int):
-        response = retryRequest(lambda: requests.get(f"{self.host}/api/v3/command/{commandId}?apiKey={self.apiKey}"))
+        response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/command/{commandId}?apiKey={self.apiKey}"))
         return response.json()
     
 class Sonarr(Arr):
@@ -342,8 +395,8 @@ class Sonarr(Arr):
     childName = 'Season'
     grandchildName = 'Episode'
 
-    def __init__(self) -> None:
-        super().__init__(Sonarr.host, Sonarr.apiKey, Sonarr.endpoint, Sonarr.fileEndpoint, Sonarr.childIdName, Sonarr.childName, Sonarr.grandchildName, Show, EpisodeFile, EpisodeHistory)
+    def __init__(self, host: str=None, apiKey: str=None) -> None:
+        super().__init__(host or Sonarr.host, apiKey or Sonarr.apiKey, Sonarr.endpoint, Sonarr.fileEndpoint, Sonarr.childIdName, Sonarr.childName, Sonarr.grandchildName, Show, EpisodeFile, EpisodeHistory)
 
     def _automaticSearchJson(self, media: Media, childId: int):
         return {"name": f"{self.childName}Search", f"{self.endpoint}Id": media.id, self.childIdName: childId}
@@ -363,8 +416,236 @@ class Radarr(Arr):
     childName = 'Movies'
     grandchildName = 'Movie'
 
-    def __init__(self) -> None:
-        super().__init__(Radarr.host, Radarr.apiKey, Radarr.endpoint, Radarr.fileEndpoint, Radarr.childIdName, Radarr.childName, Radarr.grandchildName, Movie, MovieFile, MovieHistory)
+    def __init__(self, host: str=None, apiKey: str=None) -> None:
+        super().__init__(host or Radarr.host, apiKey or Radarr.apiKey, Radarr.endpoint, Radarr.fileEndpoint, Radarr.childIdName, Radarr.childName, Radarr.grandchildName, Movie, MovieFile, MovieHistory)
 
     def _automaticSearchJson(self, media: Media, childId: int):
         return {"name": f"{self.childName}Search", f"{self.endpoint}Ids": [media.id]}
+
+    def getFilesByMedia(self, media: List[Media], workers: int = 8, chunkSize: int = 250):
+        """
+        Get the files of many movies, chunkSize movies per request.
+        Radarr requires movie IDs to list files, but takes many at once, so a whole library needs only a few requests.
+
+        :return: A dict of each movie's ID to its files. Movies in chunks that couldn't be fetched are left out.
+        """
+        ids = [movie.id for movie in media]
+        chunks = [ids[i:i + chunkSize] for i in range(0, len(ids), chunkSize)]
+
+        def getChunk(chunkIds):
+            try:
+                query = '&'.join(f"{self.endpoint}Id={id}" for id in chunkIds)
+                response = self._retryRequest(lambda: requests.get(f"{self.host}/api/v3/{self.fileEndpoint}?apiKey={self.apiKey}&{query}"))
+                return list(map(self.fileConstructor, response.json()))
+            except Exception as e:
+                print(f"Error getting the files of {len(chunkIds)} movies: {e}")
+                return None
+
+        filesByMedia = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='files') as executor:
+            for chunkIds, files in zip(chunks, executor.map(getChunk, chunks)):
+                if files is None:
+                    continue
+                for id in chunkIds:
+                    filesByMedia.setdefault(id, [])
+                for file in files:
+                    filesByMedia.setdefault(file.parentId, []).append(file)
+
+        return filesByMedia
+
+class RefreshScheduler():
+    """
+    Coalesces RefreshMonitoredDownloads commands for a single Arr instance.
+    Every completed download joins one command stream, which stops once all pending downloads show up as imported in the Arr's history.
+    Only imports dated after a download joined count for it, so a re-grab isn't mistaken as imported by the previous grab's import.
+    """
+    _schedulers = {}
+
+    @classmethod
+    def forArr(cls, arr: Arr):
+        key = (arr.host, arr.apiKey)
+        if key not in cls._schedulers:
+            cls._schedulers[key] = cls(arr)
+        return cls._schedulers[key]
+
+    def __init__(self, arr: Arr, interval=1, historyPageSize=100, clockSkew=30) -> None:
+        """:param clockSkew: Seconds the Arr's clock may be behind this one by."""
+        self.arr = arr
+        self.interval = interval
+        self.historyPageSize = historyPageSize
+        self.clockSkew = timedelta(seconds=clockSkew)
+        self.pending = []
+        self.task = None
+
+    async def refresh(self, folderNames: List[str], maxRefreshes=60):
+        """
+        Refresh the Arr until every folder has been imported from.
+
+        :param folderNames: The names of the completed folders the download was placed in.
+        :param maxRefreshes: The number of refreshes to wait for the import before giving up.
+        :return: True if the import was seen, False if it was not seen in time.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append({'folderNames': set(folderNames), 'future': future, 'refreshesLeft': maxRefreshes, 'since': datetime.now(timezone.utc) - self.clockSkew})
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+        return await future
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.to_thread(self.arr.refreshMonitoredDownloads)
+            await asyncio.sleep(self.interval)
+
+            try:
+                imports = await self._getImports()
+            except Exception as e:
+                print(f"Error checking {self.arr.__class__.__name__} imports: {e}")
+                imports = []
+
+            for item in list(self.pending):
+                for date, folderNames in imports:
+                    if date >= item['since']:
+                        item['folderNames'] -= folderNames
+                item['refreshesLeft'] -= 1
+                if item['future'].done():
+                    self.pending.remove(item)
+                elif not item['folderNames'] or item['refreshesLeft'] <= 0:
+                    item['future'].set_result(not item['folderNames'])
+                    self.pending.remove(item)
+
+    async def _getImports(self):
+        """:return: The date and the folder names of each recent import."""
+        history = await asyncio.to_thread(self.arr.getHistory, self.historyPageSize, eventType=Arr.downloadFolderImportedEventType)
+        # The Arr may see the watch folder under a different mount, so match on path components rather than the full path
+        return [(item.date, set(re.split(r'[\\/]', item.droppedPath))) for item in history if item.isDownloadFolderImportedEvent and item.droppedPath]
+
+class FileCatalog():
+    """
+    An Arr's files grouped by parentId (season number for Sonarr, movie ID for Radarr), for a single pass over its media.
+    Each media item's file list is fetched once and its children are served from memory,
+    so create a new catalog for every pass to see the files changed since.
+    """
+    def __init__(self, arr: Arr) -> None:
+        self.arr = arr
+        self.filesByMedia = {}
+
+    def getFiles(self, media: Media, childId: int = None) -> List[MediaFile]:
+        filesByParent = self._getFilesByParent(media)
+        if childId is None:
+            return [file for files in filesByParent.values() for file in files]
+        return filesByParent.get(childId, [])
+
+    def prefetch(self, media: List[Media], workers: int = 8):
+        """Fetch the files of every media item up front, in as few requests as the Arr allows."""
+        for id, files in self.arr.getFilesByMedia(media, workers).items():
+            self.filesByMedia[id] = self._groupByParent(files)
+
+    def _getFilesByParent(self, media: Media):
+        if media.id not in self.filesByMedia:
+            self.filesByMedia[media.id] = self._groupByParent(self.arr.getFiles(media))
+        return self.filesByMedia[media.id]
+
+    def _groupByParent(self, files):
+        filesByParent = {}
+        for file in files:
+            filesByParent.setdefault(file.parentId, []).append(file)
+        return filesByParent
+
+# From Radarr Radarr/src/NzbDrone.Core/Organizer/FileNameBuilder.cs
+def cleanFileName(name):
+    result = name
+    badCharacters = ["\\", "/", "<", ">", "?", "*", ":", "|", "\""]
+    goodCharacters = ["+", "+", "", "", "!", "-", "", "", ""]
+
+    for i, char in enumerate(badCharacters):
+        result = result.replace(char, goodCharacters[i])
+    
+    return result.strip()
+
+class HistoryIndex():
+    """
+    In-process index of an Arr's history by torrent hash and cleaned source title.
+    After the first fill each update only pages through records newer than the newest one already seen,
+    and concurrent lookups share the same update.
+    """
+    _indexes = {}
+
+    @classmethod
+    def forArr(cls, arr: Arr, initialSize: int=None):
+        key = (arr.host, arr.apiKey)
+        if key not in cls._indexes:
+            cls._indexes[key] = cls(arr, initialSize)
+        return cls._indexes[key]
+
+    def __init__(self, arr: Arr, initialSize: int=None, pageSize=100, maxPages=10, maxRecords=10000) -> None:
+        self.arr = arr
+        self.initialSize = initialSize or pageSize
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.maxRecords = maxRecords
+        self.records = {}
+        self.idsByHash = {}
+        self.idsByTitle = {}
+        self.lastId = None
+        self.task = None
+
+    async def find(self, torrentHash: str, title: str) -> List[MediaHistory]:
+        """
+        Get the history records for a torrent, newest first.
+
+        :param torrentHash: Matched against the records' torrentInfoHash, case insensitively.
+        :param title: Matched against the records' cleaned source title, case insensitively.
+        """
+        await self.update()
+
+        ids = self.idsByHash.get(torrentHash.casefold(), set()) | self.idsByTitle.get(title.casefold(), set())
+        return [self.records[id] for id in sorted(ids, reverse=True)]
+
+    async def update(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(asyncio.to_thread(self._update))
+        await asyncio.shield(self.task)
+
+    def _update(self):
+        if self.lastId is None:
+            self._add(self.arr.getHistory(self.initialSize, includeGrandchildDetails=True))
+            # An empty history still counts as filled, later updates only page through what's new
+            self.lastId = self.lastId or 0
+            return
+
+        lastId = self.lastId
+        for page in range(1, self.maxPages + 1):
+            history = list(self.arr.getHistory(self.pageSize, includeGrandchildDetails=True, page=page, sortKey='date'))
+            newItems = [item for item in history if item.id > lastId]
+            self._add(newItems)
+
+            # Stop at the first page that reaches records already indexed
+            if len(newItems) < len(history) or len(history) < self.pageSize:
+                break
+
+    def _add(self, history):
+        for item in history:
+            if item.id in self.records:
+                continue
+
+            self.records[item.id] = item
+            if item.torrentInfoHash:
+                self.idsByHash.setdefault(item.torrentInfoHash.casefold(), set()).add(item.id)
+            self.idsByTitle.setdefault(cleanFileName(item.sourceTitle.casefold()), set()).add(item.id)
+            self.lastId = max(self.lastId or 0, item.id)
+
+        # Drop the oldest records so a long running watcher doesn't grow without bound
+        for id in sorted(self.records)[:max(len(self.records) - self.maxRecords, 0)]:
+            item = self.records.pop(id)
+            if item.torrentInfoHash:
+                self._discard(self.idsByHash, item.torrentInfoHash.casefold(), id)
+            self._discard(self.idsByTitle, cleanFileName(item.sourceTitle.casefold()), id)
+
+    def _discard(self, index, key, id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del index[key]
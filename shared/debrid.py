@@ -1,13 +1,17 @@
 import asyncio
 import os
 import re
+import time
+import base64
+import random
 import hashlib
 import requests
 from abc import ABC, abstractmethod
 from urllib.parse import urljoin
 from datetime import datetime
 from shared.discord import discordUpdate
-from shared.requests import retryRequest
+from shared.requests import getAsyncClient, retryRequestAsync
+from shared.mount import MountIndex
 from shared.shared import realdebrid, torbox, mediaExtensions, checkRequiredEnvs
 
 def validateDebridEnabled():
@@ -95,7 +99,454 @@ if torbox['enabled']:
 
 checkRequiredEnvs(requiredEnvs)
 
+class TorrentMetadata():
+    def __init__(self, infoHash, files) -> None:
+        self.infoHash = infoHash
+        # (path, length) for each file, with paths relative to the torrent's folder
+        self.files = files
+
+def scanTorrent(data: bytes) -> TorrentMetadata:
+    """
+    Hash a .torrent file's bencoded 'info' value straight from its bytes, collecting the file list in the same pass.
+    Unlike decoding and re-encoding the whole file, the piece table is skipped over rather than copied.
+    """
+    if data[:1] != b'd':
+        raise ValueError("Torrent file is not a bencoded dictionary")
+
+    index = 1
+    while data[index:index + 1] != b'e':
+        key, index = _decodeBencode(data, index)
+        if key == b'info':
+            infoStart = index
+            index, name, files = _scanInfo(data, index)
+            infoHash = hashlib.sha1(memoryview(data)[infoStart:index]).hexdigest()
+            return TorrentMetadata(infoHash, [(os.path.join(name, *path) if path else name, length) for path, length in files])
+        index = _skipBencode(data, index)
+
+    raise ValueError("Torrent file has no info dictionary")
+
+def _scanInfo(data, index):
+    if data[index:index + 1] != b'd':
+        raise ValueError("Torrent info is not a bencoded dictionary")
+
+    values = {}
+    index += 1
+    while data[index:index + 1] != b'e':
+        key, index = _decodeBencode(data, index)
+        if key in (b'name', b'name.utf-8', b'length', b'files'):
+            values[key], index = _decodeBencode(data, index)
+        else:
+            index = _skipBencode(data, index)
+
+    name = _decodeString(values.get(b'name.utf-8') or values.get(b'name', b''))
+    if b'files' in values:
+        files = [([_decodeString(part) for part in file.get(b'path.utf-8') or file[b'path']], file[b'length']) for file in values[b'files']]
+    else:
+        files = [([], values.get(b'length', 0))]
+
+    return index + 1, name, files
+
+def _skipBencode(data, index):
+    """Return the index just past the value starting at index, without decoding it."""
+    token = data[index:index + 1]
+    if token == b'i':
+        return data.index(b'e', index) + 1
+    elif token in (b'l', b'd'):
+        index += 1
+        while data[index:index + 1] != b'e':
+            index = _skipBencode(data, index)
+        return index + 1
+    elif token.isdigit():
+        colon = data.index(b':', index)
+        return colon + 1 + int(data[index:colon])
+    raise ValueError(f"Invalid bencode at byte {index}")
+
+def _decodeBencode(data, index):
+    """Decode the value starting at index, returning it with the index just past it."""
+    token = data[index:index + 1]
+    if token == b'i':
+        end = data.index(b'e', index)
+        return int(data[index + 1:end]), end + 1
+    elif token == b'l':
+        values = []
+        index += 1
+        while data[index:index + 1] != b'e':
+            value, index = _decodeBencode(data, index)
+            values.append(value)
+        return values, index + 1
+    elif token == b'd':
+        values = {}
+        index += 1
+        while data[index:index + 1] != b'e':
+            key, index = _decodeBencode(data, index)
+            values[key], index = _decodeBencode(data, index)
+        return values, index + 1
+    elif token.isdigit():
+        colon = data.index(b':', index)
+        end = colon + 1 + int(data[index:colon])
+        if end > len(data):
+            raise ValueError(f"Truncated bencode string at byte {index}")
+        return data[colon + 1:end], end
+    raise ValueError(f"Invalid bencode at byte {index}")
+
+def _decodeString(value):
+    return value.decode(errors='replace') if isinstance(value, bytes) else str(value)
+
+def normalizeHash(torrentHash):
+    """Lowercase hex infohash, converting the base32 form some magnets use."""
+    if len(torrentHash) == 32:
+        return base64.b32decode(torrentHash.upper()).hex()
+    return torrentHash.lower()
+
+class StatusPoller(ABC):
+    """
+    Fetches the status of every torrent on a debrid account once per tick and hands it to all the torrents waiting on it,
+    so the API cost stays constant as the number of in-flight torrents grows.
+    """
+    _pollers = {}
+
+    @classmethod
+    def forAccount(cls, apiKey):
+        key = (cls, apiKey)
+        if key not in StatusPoller._pollers:
+            StatusPoller._pollers[key] = cls(apiKey)
+        return StatusPoller._pollers[key]
+
+    def __init__(self, apiKey, interval=1, maxMisses=60, libraryMaxAge=300) -> None:
+        self.headers = {'Authorization': f'Bearer {apiKey}'}
+        self.interval = interval
+        self.maxMisses = maxMisses
+        self.waiters = {}
+        self.task = None
+        self.libraryMaxAge = libraryMaxAge
+        self.library = {}
+        self.libraryUpdated = None
+        self.libraryTask = None
+
+    async def findByHash(self, torrentHash):
+        """
+        Look up a torrent already on the account by infohash.
+        The whole account is listed at most once per libraryMaxAge, and kept fresh in between by the status ticks.
+
+        :return: A copy of the torrent's info, or None if it isn't on the account.
+        """
+        if self.libraryUpdated is None or time.monotonic() - self.libraryUpdated > self.libraryMaxAge:
+            if self.libraryTask is None or self.libraryTask.done():
+                self.libraryTask = asyncio.create_task(self._refreshLibrary())
+            await asyncio.shield(self.libraryTask)
+
+        torrent = self.library.get(normalizeHash(torrentHash))
+        return dict(torrent) if torrent else None
+
+    async def _refreshLibrary(self):
+        torrents = await self._fetchAll()
+        # Also stamped on failure so a broken list endpoint isn't retried for every file
+        self.libraryUpdated = time.monotonic()
+        if torrents is not None:
+            self.library = {}
+            self._indexLibrary(torrents)
+
+    def forget(self, torrentHash):
+        """Drop a deleted torrent from the library, so findByHash doesn't return it until the next full listing."""
+        self.library.pop(normalizeHash(torrentHash), None)
+
+    def _indexLibrary(self, torrents):
+        for torrent in torrents:
+            if torrent.get('hash'):
+                self.library[torrent['hash'].lower()] = torrent
+
+    async def wait(self, torrentId):
+        """
+        Wait for the next tick that includes the torrent.
+
+        :return: A copy of the torrent's info, or None if the torrent was missing, or the fetch failed, for maxMisses ticks in a row.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(torrentId, []).append([future, 0])
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+        return await future
+
+    async def _run(self):
+        while self.waiters:
+            try:
+                torrents = await self._fetch(list(self.waiters))
+            except Exception as e:
+                print(f"Error fetching torrent statuses: {e}")
+                torrents = None
+
+            # A failed fetch is a miss for every waiter rather than a failure, so one bad response doesn't fail every torrent in flight
+            if torrents is not None:
+                self._indexLibrary(torrents.values())
+            else:
+                torrents = {}
+
+            for torrentId, waiters in list(self.waiters.items()):
+                info = torrents.get(torrentId)
+                remaining = []
+                for waiter in waiters:
+                    future, misses = waiter
+                    if future.done():
+                        # Cancelled by the waiting torrent
+                        continue
+                    if info:
+                        future.set_result(dict(info))
+                    elif misses + 1 >= self.maxMisses:
+                        future.set_result(None)
+                    else:
+                        waiter[1] += 1
+                        remaining.append(waiter)
+
+                if remaining:
+                    self.waiters[torrentId] = remaining
+                else:
+                    del self.waiters[torrentId]
+
+            if self.waiters:
+                await asyncio.sleep(self.interval)
+
+    @abstractmethod
+    async def _fetch(self, torrentIds):
+        """
+        :param torrentIds: The ids currently being waited on.
+        :return: A dict of torrent infos keyed by id, or None if the request failed.
+        """
+        pass
+
+    @abstractmethod
+    async def _fetchAll(self):
+        """
+        :return: A list of every torrent on the account, or None if the request failed.
+        """
+        pass
+
+class RealDebridPoller(StatusPoller):
+    pageSize = 100
+    maxPages = 10
+    maxInfoRequests = 4
+    libraryPageSize = 2500
+
+    async def _fetchPage(self, page, limit):
+        """
+        :return: The torrents on the page, an empty list past the last page, or None if the request failed.
+        """
+        torrentsRequest = await retryRequestAsync(
+            lambda: getAsyncClient().get(urljoin(realdebrid['host'], "torrents"), headers=self.headers, params={'page': page, 'limit': limit})
+        )
+        if torrentsRequest is None:
+            return None
+        if torrentsRequest.status_code == 204:
+            return []
+
+        return torrentsRequest.json()
+
+    async def _fetch(self, torrentIds):
+        torrents = {}
+        wanted = set(torrentIds)
+
+        # The list is sorted newest first, so in-flight torrents are almost always on the first page
+        for page in range(1, self.maxPages + 1):
+            pageTorrents = await self._fetchPage(page, self.pageSize)
+            if pageTorrents is None:
+                if page == 1:
+                    return None
+                break
+
+            torrents.update((torrent['id'], torrent) for torrent in pageTorrents)
+            if wanted <= torrents.keys() or len(pageTorrents) < self.pageSize:
+                break
+
+        # Fall back to a bounded fan-out of info requests for anything not on the scanned pages
+        missing = wanted - torrents.keys()
+        if missing:
+            semaphore = asyncio.Semaphore(self.maxInfoRequests)
+
+            async def getInfo(torrentId):
+                async with semaphore:
+                    infoRequest = await retryRequestAsync(
+                        lambda: getAsyncClient().get(urljoin(realdebrid['host'], f"torrents/info/{torrentId}"), headers=self.headers)
+                    )
+                    if infoRequest is not None:
+                        torrents[torrentId] = infoRequest.json()
+
+            await asyncio.gather(*(getInfo(torrentId) for torrentId in missing))
+
+        return torrents
+
+    async def _fetchAll(self):
+        torrents = []
+        page = 1
+        while True:
+            pageTorrents = await self._fetchPage(page, self.libraryPageSize)
+            if pageTorrents is None:
+                return None
+
+            torrents.extend(pageTorrents)
+            if len(pageTorrents) < self.libraryPageSize:
+                return torrents
+            page += 1
+
+class TorboxPoller(StatusPoller):
+    async def _fetch(self, torrentIds):
+        torrents = await self._fetchAll()
+        if torrents is None:
+            return None
+
+        return {torrent['id']: torrent for torrent in torrents}
+
+    async def _fetchAll(self):
+        infoRequest = await retryRequestAsync(
+            lambda: getAsyncClient().get(urljoin(torbox['host'], "torrents/mylist"), headers=self.headers)
+        )
+        if infoRequest is None:
+            return None
+
+        return infoRequest.json()['data']
+
+class TorboxCacheChecker():
+    """
+    Batches TorBox cache checks: hashes asked for within window seconds of each other go out together in one checkcached request
+    (batchSize at most), and the answers are kept for ttl seconds so re-grabs of the same release skip the check.
+    """
+    _checkers = {}
+
+    @classmethod
+    def forAccount(cls, apiKey):
+        if apiKey not in cls._checkers:
+            cls._checkers[apiKey] = cls(apiKey)
+        return cls._checkers[apiKey]
+
+    def __init__(self, apiKey, window=0.5, batchSize=100, ttl=3600) -> None:
+        self.headers = {'Authorization': f'Bearer {apiKey}'}
+        self.window = window
+        self.batchSize = batchSize
+        self.ttl = ttl
+        # hash -> (expiry, cached availability or None)
+        self.cache = {}
+        self.pending = {}
+        self.flushHandle = None
+
+    async def check(self, torrentHash, refresh=False):
+        """
+        :return: TorBox's cached entry for the hash, or None if it isn't cached or the check failed.
+        """
+        return await asyncio.shield(self._request(normalizeHash(torrentHash), refresh))
+
+    def prefetch(self, torrentHashes):
+        """Add hashes to the next batch without waiting for the answers."""
+        for torrentHash in torrentHashes:
+            # Nobody may wait on a prefetched check, so its failure is retrieved here rather than reported as unhandled
+            self._request(normalizeHash(torrentHash)).add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    def _request(self, torrentHash, refresh=False):
+        loop = asyncio.get_running_loop()
+        cached = self.cache.get(torrentHash)
+        if cached and not refresh and cached[0] > time.monotonic():
+            future = loop.create_future()
+            future.set_result(cached[1])
+            return future
+
+        if torrentHash not in self.pending:
+            self.pending[torrentHash] = loop.create_future()
+            if len(self.pending) >= self.batchSize:
+                self._flush()
+            elif self.flushHandle is None:
+                self.flushHandle = loop.call_later(self.window, self._flush)
+        return self.pending[torrentHash]
+
+    def _flush(self):
+        if self.flushHandle:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+
+        batch, self.pending = self.pending, {}
+        if batch:
+            asyncio.create_task(self._check(batch))
+
+    async def _check(self, batch):
+        try:
+            cachedRequest = await retryRequestAsync(
+                lambda: getAsyncClient().get(
+                    urljoin(torbox['host'], "torrents/checkcached"),
+                    headers=self.headers,
+                    params={'hash': ','.join(batch), 'format': 'object'}
+                )
+            )
+            data = cachedRequest.json().get('data') if cachedRequest is not None else None
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Failed checks aren't cached, so the next file with the hash asks again
+        expiry = time.monotonic() + self.ttl
+        data = {torrentHash.lower(): availability for torrentHash, availability in (data or {}).items()}
+        for torrentHash, future in batch.items():
+            availability = data.get(torrentHash) or None
+            if cachedRequest is not None:
+                self.cache[torrentHash] = (expiry, availability)
+            if not future.done():
+                future.set_result(availability)
+
+class PollingPolicy():
+    """
+    Decides how long a torrent waits between status checks, and when it has run out of time.
+    Downloads that make progress are checked around when they are expected to finish, stalled or queued ones back off
+    exponentially, and anything close to done is checked on every poller tick. Deadlines are measured in wall-clock time.
+    """
+    def __init__(self, timeout=None, minInterval=1, maxInterval=30, backoff=1.5, jitter=0.1, nearCompletion=0.95) -> None:
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.nearCompletion = nearCompletion
+        self.interval = minInterval
+        self.lastStatus = None
+        self.lastProgress = None
+        self.lastTime = None
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def nextInterval(self, status, progress=None):
+        """
+        :param status: The torrent's normalized status.
+        :param progress: The download progress as a fraction between 0 and 1, if known.
+        :return: The seconds to sleep before the next check.
+        """
+        now = time.monotonic()
+        if status != TorrentBase.STATUS_DOWNLOADING:
+            # Nothing to wait for, e.g. files to select
+            interval = 0
+        elif progress is not None and progress >= self.nearCompletion:
+            interval = 0
+        elif status != self.lastStatus:
+            interval = self.minInterval
+        elif progress is not None and self.lastProgress is not None and progress > self.lastProgress:
+            rate = (progress - self.lastProgress) / (now - self.lastTime)
+            interval = min(max((1 - progress) / rate, self.minInterval), self.maxInterval)
+        else:
+            interval = min(self.interval * self.backoff, self.maxInterval)
+
+        self.interval = max(interval, self.minInterval)
+        self.lastStatus = status
+        self.lastProgress = progress
+        self.lastTime = now
+
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        if self.deadline is not None:
+            interval = min(interval, max(self.deadline - now, 0))
+
+        return interval
+
 class TorrentBase(ABC):
+    provider = None
+    # The value of 'progress' in the torrent's info once it's fully downloaded
+    maxProgress = 100
     STATUS_WAITING_FILES_SELECTION = 'waiting_files_selection'
     STATUS_DOWNLOADING = 'downloading'
     STATUS_COMPLETED = 'completed'
@@ -109,6 +560,7 @@ class TorrentBase(ABC):
         self.failIfNotCached = failIfNotCached
         self.onlyLargestFile = onlyLargestFile
         self.skipAvailabilityCheck = False
+        self.attached = False
         self.id = None
         self._info = None
         self._hash = None
@@ -118,7 +570,7 @@ class TorrentBase(ABC):
         print(f"[{datetime.now()}] [{self.__class__.__name__}] [{self.file.fileInfo.filenameWithoutExt}]", *values)
 
     @abstractmethod
-    def submitTorrent(self):
+    async def submitTorrent(self):
         pass
 
     @abstractmethod
@@ -126,7 +578,7 @@ class TorrentBase(ABC):
         pass
     
     @abstractmethod
-    def addTorrent(self):
+    async def addTorrent(self):
         pass
     
     @abstractmethod
@@ -138,19 +590,47 @@ class TorrentBase(ABC):
         pass
 
     @abstractmethod
-    def delete(self):
+    async def delete(self):
         pass
 
     @abstractmethod
-    async def getTorrentPath(self):
+    async def getTorrentPath(self, timeout=0):
+        """Wait up to timeout seconds for the torrent's folder to appear in the mount. Returns None if it doesn't."""
         pass
 
     @abstractmethod
-    def _addTorrentFile(self):
+    async def _addTorrentFile(self):
         pass
 
     @abstractmethod
-    def _addMagnetFile(self):
+    async def _addMagnetFile(self):
+        pass
+
+    def attach(self, torrentId):
+        """
+        Use a torrent added by someone else instead of adding this one.
+        Attached torrents are never deleted, since the other owner still needs them.
+        """
+        if not torrentId:
+            return False
+
+        self.id = torrentId
+        self.attached = True
+        return True
+
+    async def attachExisting(self):
+        """Attach to a finished torrent with the same infohash already on the account."""
+        info = await self._findExisting()
+        if not info or info['status'] != self.STATUS_COMPLETED:
+            return False
+
+        self.print('attached to existing torrent:', info['id'])
+        self._info = info
+        return self.attach(info['id'])
+
+    @abstractmethod
+    async def _findExisting(self):
+        """:return: The normalized info of a torrent with the same infohash on the account, or None."""
         pass
 
     def _enforceId(self):
@@ -158,19 +638,21 @@ class TorrentBase(ABC):
             raise Exception("Id is required. Must be acquired via successfully running submitTorrent() first.")
 
 class RealDebrid(TorrentBase):
+    provider = 'RealDebrid'
+
     def __init__(self, f, fileData, file, failIfNotCached, onlyLargestFile) -> None:
         super().__init__(f, fileData, file, failIfNotCached, onlyLargestFile)
         self.headers = {'Authorization': f'Bearer {realdebrid["apiKey"]}'}
         self.mountTorrentsPath = realdebrid["mountTorrentsPath"]
 
-    def submitTorrent(self):
+    async def submitTorrent(self):
         if self.failIfNotCached:
             instantAvailability = self._getInstantAvailability()
             self.print('instantAvailability:', not not instantAvailability)
             if not instantAvailability:
                 return False
 
-        return not not self.addTorrent()
+        return not not await self.addTorrent()
 
     def _getInstantAvailability(self, refresh=False):
         torrentHash = self.getHash()
@@ -179,9 +661,9 @@ class RealDebrid(TorrentBase):
 
         return True
     
-    def _getAvailableHost(self):
-        availableHostsRequest = retryRequest(
-            lambda: requests.get(urljoin(realdebrid['host'], "torrents/availableHosts"), headers=self.headers),
+    async def _getAvailableHost(self):
+        availableHostsRequest = await retryRequestAsync(
+            lambda: getAsyncClient().get(urljoin(realdebrid['host'], "torrents/availableHosts"), headers=self.headers),
             print=self.print
         )
         if availableHostsRequest is None:
@@ -190,18 +672,26 @@ class RealDebrid(TorrentBase):
         availableHosts = availableHostsRequest.json()
         return availableHosts[0]['host']
     
-    async def getInfo(self, refresh=False):
+    async def getInfo(self, refresh=False, full=False):
+        """
+        Status refreshes come from the shared torrents list poller, which omits 'files' and 'original_filename'.
+        Pass full to fetch those from the torrent's own info endpoint.
+        """
         self._enforceId()
 
-        if refresh or not self._info:
-            infoRequest = retryRequest(
-                lambda: requests.get(urljoin(realdebrid['host'], f"torrents/info/{self.id}"), headers=self.headers),
-                print=self.print
-            )
-            if infoRequest is None:
+        if refresh or not self._info or (full and 'files' not in self._info):
+            if full:
+                infoRequest = await retryRequestAsync(
+                    lambda: getAsyncClient().get(urljoin(realdebrid['host'], f"torrents/info/{self.id}"), headers=self.headers),
+                    print=self.print
+                )
+                info = infoRequest.json() if infoRequest is not None else None
+            else:
+                info = await RealDebridPoller.forAccount(realdebrid['apiKey']).wait(self.id)
+
+            if info is None:
                 self._info = None
             else:
-                info = infoRequest.json()
                 info['status'] = self._normalize_status(info['status'])
                 self._info = info
 
@@ -210,7 +700,7 @@ class RealDebrid(TorrentBase):
     async def selectFiles(self):
         self._enforceId()
 
-        info = await self.getInfo()
+        info = await self.getInfo(full=True)
         if info is None:
             return False
 
@@ -233,8 +723,8 @@ class RealDebrid(TorrentBase):
             discordUpdate('largest file:', largestMediaFile['path'])
                 
         files = {'files': [largestMediaFileId] if self.onlyLargestFile else ','.join(mediaFileIds)}
-        selectFilesRequest = retryRequest(
-            lambda: requests.post(urljoin(realdebrid['host'], f"torrents/selectFiles/{self.id}"), headers=self.headers, data=files),
+        selectFilesRequest = await retryRequestAsync(
+            lambda: getAsyncClient().post(urljoin(realdebrid['host'], f"torrents/selectFiles/{self.id}"), headers=self.headers, data=files),
             print=self.print
         )
         if selectFilesRequest is None:
@@ -242,43 +732,59 @@ class RealDebrid(TorrentBase):
         
         return True
 
-    def delete(self):
+    async def delete(self):
         self._enforceId()
+        if self.attached:
+            return False
 
-        deleteRequest = retryRequest(
-            lambda: requests.delete(urljoin(realdebrid['host'], f"torrents/delete/{self.id}"), headers=self.headers),
+        deleteRequest = await retryRequestAsync(
+            lambda: getAsyncClient().delete(urljoin(realdebrid['host'], f"torrents/delete/{self.id}"), headers=self.headers),
             print=self.print
         )
+        if deleteRequest:
+            RealDebridPoller.forAccount(realdebrid['apiKey']).forget(self.getHash())
         return not not deleteRequest
 
 
-    async def getTorrentPath(self):
-        filename = (await self.getInfo())['filename']
-        originalFilename = (await self.getInfo())['original_filename']
+    async def _findExisting(self):
+        torrent = await RealDebridPoller.forAccount(realdebrid['apiKey']).findByHash(self.getHash())
+        if not torrent:
+            return None
+
+        infoRequest = await retryRequestAsync(
+            lambda: getAsyncClient().get(urljoin(realdebrid['host'], f"torrents/info/{torrent['id']}"), headers=self.headers),
+            print=self.print
+        )
+        if infoRequest is None:
+            return None
+
+        info = infoRequest.json()
+        info['status'] = self._normalize_status(info['status'])
+
+        # The existing torrent may have been added for a single episode of what is now wanted as a pack
+        if not self.onlyLargestFile and any(not file['selected'] for file in info['files'] if os.path.splitext(file['path'])[1].lower() in mediaExtensions):
+            self.print('existing torrent is missing files:', torrent['id'])
+            return None
 
-        folderPathMountFilenameTorrent = os.path.join(self.mountTorrentsPath, filename)
-        folderPathMountOriginalFilenameTorrent = os.path.join(self.mountTorrentsPath, originalFilename)
-        folderPathMountOriginalFilenameWithoutExtTorrent = os.path.join(self.mountTorrentsPath, os.path.splitext(originalFilename)[0])
+        return info
 
-        if os.path.exists(folderPathMountFilenameTorrent) and os.listdir(folderPathMountFilenameTorrent):
-            folderPathMountTorrent = folderPathMountFilenameTorrent
-        elif os.path.exists(folderPathMountOriginalFilenameTorrent) and os.listdir(folderPathMountOriginalFilenameTorrent):
-            folderPathMountTorrent = folderPathMountOriginalFilenameTorrent
-        elif (originalFilename.endswith(('.mkv', '.mp4')) and
-                os.path.exists(folderPathMountOriginalFilenameWithoutExtTorrent) and os.listdir(folderPathMountOriginalFilenameWithoutExtTorrent)):
-            folderPathMountTorrent = folderPathMountOriginalFilenameWithoutExtTorrent
-        else:
-            folderPathMountTorrent = None
+    async def getTorrentPath(self, timeout=0):
+        filename = (await self.getInfo(full=True))['filename']
+        originalFilename = (await self.getInfo(full=True))['original_filename']
+
+        folderNames = [filename, originalFilename]
+        if originalFilename.endswith(('.mkv', '.mp4')):
+            folderNames.append(os.path.splitext(originalFilename)[0])
 
-        return folderPathMountTorrent
+        return await MountIndex.forPath(self.mountTorrentsPath).waitFor(folderNames, timeout)
 
-    def _addFile(self, request, endpoint, data):
-        host = self._getAvailableHost()
+    async def _addFile(self, method, endpoint, **kwargs):
+        host = await self._getAvailableHost()
         if host is None:
             return None
 
-        request = retryRequest(
-            lambda: request(urljoin(realdebrid['host'], endpoint), params={'host': host}, headers=self.headers, data=data),
+        request = await retryRequestAsync(
+            lambda: getAsyncClient().request(method, urljoin(realdebrid['host'], endpoint), params={'host': host}, headers=self.headers, **kwargs),
             print=self.print
         )
         if request is None:
@@ -290,11 +796,11 @@ class RealDebrid(TorrentBase):
 
         return self.id
 
-    def _addTorrentFile(self):
-        return self._addFile(requests.put, "torrents/addTorrent", self.f)
+    async def _addTorrentFile(self):
+        return await self._addFile('PUT', "torrents/addTorrent", content=self.fileData)
 
-    def _addMagnetFile(self):
-        return self._addFile(requests.post, "torrents/addMagnet", {'magnet': self.fileData})
+    async def _addMagnetFile(self):
+        return await self._addFile('POST', "torrents/addMagnet", data={'magnet': self.fileData})
     
     def _normalize_status(self, status):
         if status in ['waiting_files_selection']:
@@ -308,6 +814,12 @@ class RealDebrid(TorrentBase):
         return status
 
 class Torbox(TorrentBase):
+    provider = 'Torbox'
+    maxProgress = 1
+    # The auth id only depends on the account, so it is fetched once rather than once per torrent
+    _authIds = {}
+    _authIdTasks = {}
+
     def __init__(self, f, fileData, file, failIfNotCached, onlyLargestFile) -> None:
         super().__init__(f, fileData, file, failIfNotCached, onlyLargestFile)
         self.headers = {'Authorization': f'Bearer {torbox["apiKey"]}'}
@@ -315,50 +827,49 @@ class Torbox(TorrentBase):
         self.submittedTime = None
         self.lastInactiveCheck = None
 
-        userInfoRequest = retryRequest(
-            lambda: requests.get(urljoin(torbox['host'], "user/me"), headers=self.headers),
+    async def _getAuthId(self):
+        if torbox['apiKey'] not in Torbox._authIds:
+            # Concurrent first callers share one request, a failed one is retried by the next caller
+            task = Torbox._authIdTasks.get(torbox['apiKey'])
+            if task is None or task.done():
+                task = Torbox._authIdTasks[torbox['apiKey']] = asyncio.create_task(self._fetchAuthId())
+            authId = await asyncio.shield(task)
+            if authId is None:
+                return None
+
+            Torbox._authIds[torbox['apiKey']] = authId
+
+        return Torbox._authIds[torbox['apiKey']]
+
+    async def _fetchAuthId(self):
+        userInfoRequest = await retryRequestAsync(
+            lambda: getAsyncClient().get(urljoin(torbox['host'], "user/me"), headers=self.headers),
             print=self.print
         )
-        if userInfoRequest is not None:
-            userInfo = userInfoRequest.json()
-            self.authId = userInfo['data']['auth_id']
+        if userInfoRequest is None:
+            return None
+
+        return userInfoRequest.json()['data']['auth_id']
 
-    def submitTorrent(self):
+    async def submitTorrent(self):
         if self.failIfNotCached:
-            instantAvailability = self._getInstantAvailability()
+            instantAvailability = await self._getInstantAvailability()
             self.print('instantAvailability:', not not instantAvailability)
             if not instantAvailability:
                 return False
             
-        if self.addTorrent():
+        if await self.addTorrent():
             self.submittedTime = datetime.now()
             return True
         return False
     
-    def _getInstantAvailability(self, refresh=False):
+    async def _getInstantAvailability(self, refresh=False):
         if refresh or not self._instantAvailability:
             torrentHash = self.getHash()
             self.print('hash:', torrentHash)
 
-            instantAvailabilityRequest = retryRequest(
-                lambda: requests.get(
-                    urljoin(torbox['host'], "torrents/checkcached"),
-                    headers=self.headers,
-                    params={'hash': torrentHash, 'format': 'object'}
-                ),
-                print=self.print
-            )
-            if instantAvailabilityRequest is None:
-                return None
-
-            instantAvailabilities = instantAvailabilityRequest.json()
-            self.print('instantAvailabilities:', instantAvailabilities)
-            
-            # Check if 'data' exists and is not None or False
-            if instantAvailabilities and 'data' in instantAvailabilities and instantAvailabilities['data']:
-                self._instantAvailability = instantAvailabilities['data']
-            else:
-                self._instantAvailability = None
+            self._instantAvailability = await TorboxCacheChecker.forAccount(torbox['apiKey']).check(torrentHash, refresh=refresh)
+            self.print('instantAvailability:', self._instantAvailability)
         
         return self._instantAvailability
 
@@ -366,64 +877,70 @@ class Torbox(TorrentBase):
         self._enforceId()
 
         if refresh or not self._info:
-            if not self.authId:
+            authId = await self._getAuthId()
+            if not authId:
                 return None
             
             currentTime = datetime.now()
-            if (currentTime - self.submittedTime).total_seconds() < 300:
+            # Torrents reattached after a restart have no submitted time
+            if self.submittedTime and (currentTime - self.submittedTime).total_seconds() < 300:
                 if not self.lastInactiveCheck or (currentTime - self.lastInactiveCheck).total_seconds() > 5:
-                    inactiveCheckUrl = f"https://relay.torbox.app/v1/inactivecheck/torrent/{self.authId}/{self.id}"
-                    retryRequest(
-                        lambda: requests.get(inactiveCheckUrl),
+                    inactiveCheckUrl = urljoin(torbox['relayHost'], f"v1/inactivecheck/torrent/{authId}/{self.id}")
+                    await retryRequestAsync(
+                        lambda: getAsyncClient().get(inactiveCheckUrl),
                         print=self.print
                     )
                     self.lastInactiveCheck = currentTime
-            for _ in range(60):
-                infoRequest = retryRequest(
-                    lambda: requests.get(urljoin(torbox['host'], "torrents/mylist"), headers=self.headers),
-                    print=self.print
-                )
-                if infoRequest is None:
-                    return None
 
-                torrents = infoRequest.json()['data']
-                
-                for torrent in torrents:
-                    if torrent['id'] == self.id:
-                        torrent['status'] = self._normalize_status(torrent['download_state'], torrent['download_finished'])
-                        self._info = torrent
-                        return self._info
-                
-                await asyncio.sleep(1)
+            torrent = await TorboxPoller.forAccount(torbox['apiKey']).wait(self.id)
+            if torrent is None:
+                return None
+
+            torrent['status'] = self._normalize_status(torrent['download_state'], torrent['download_finished'])
+            self._info = torrent
         return self._info
 
     async def selectFiles(self):
         pass
 
-    def delete(self):
+    async def delete(self):
         self._enforceId()
+        if self.attached:
+            return False
 
-        deleteRequest = retryRequest(
-            lambda: requests.delete(urljoin(torbox['host'], "torrents/controltorrent"), headers=self.headers, data={'torrent_id': self.id, 'operation': "Delete"}),
+        deleteRequest = await retryRequestAsync(
+            lambda: getAsyncClient().request('DELETE', urljoin(torbox['host'], "torrents/controltorrent"), headers=self.headers, data={'torrent_id': self.id, 'operation': "Delete"}),
             print=self.print
         )
+        if deleteRequest:
+            TorboxPoller.forAccount(torbox['apiKey']).forget(self.getHash())
         return not not deleteRequest
 
-    async def getTorrentPath(self):
-        filename = (await self.getInfo())['files'][0]['name'].split("/")[0]
+    async def _findExisting(self):
+        torrent = await TorboxPoller.forAccount(torbox['apiKey']).findByHash(self.getHash())
+        if not torrent:
+            return None
 
-        folderPathMountFilenameTorrent = os.path.join(self.mountTorrentsPath, filename)
-       
-        if os.path.exists(folderPathMountFilenameTorrent) and os.listdir(folderPathMountFilenameTorrent):
-            folderPathMountTorrent = folderPathMountFilenameTorrent
-        else:
-            folderPathMountTorrent = None
+        # The library can be minutes old, so check the torrent still exists before attaching to it
+        infoRequest = await retryRequestAsync(
+            lambda: getAsyncClient().get(urljoin(torbox['host'], "torrents/mylist"), headers=self.headers, params={'id': torrent['id'], 'bypass_cache': 'true'}),
+            print=self.print
+        )
+        torrent = infoRequest.json().get('data') if infoRequest is not None else None
+        if not isinstance(torrent, dict):
+            return None
+
+        torrent['status'] = self._normalize_status(torrent['download_state'], torrent['download_finished'])
+        return torrent
+
+    async def getTorrentPath(self, timeout=0):
+        filename = (await self.getInfo())['files'][0]['name'].split("/")[0]
 
-        return folderPathMountTorrent
+        return await MountIndex.forPath(self.mountTorrentsPath).waitFor([filename], timeout)
 
-    def _addFile(self, data=None, files=None):
-        request = retryRequest(
-            lambda: requests.post(urljoin(torbox['host'], "torrents/createtorrent"), headers=self.headers, data=data, files=files),
+    async def _addFile(self, data=None, files=None):
+        request = await retryRequestAsync(
+            lambda: getAsyncClient().post(urljoin(torbox['host'], "torrents/createtorrent"), headers=self.headers, data=data, files=files),
             print=self.print
         )
         if request is None:
@@ -439,13 +956,13 @@ class Torbox(TorrentBase):
 
         return self.id
 
-    def _addTorrentFile(self):
+    async def _addTorrentFile(self):
         nametorrent = self.f.name.split('/')[-1]
-        files = {'file': (nametorrent, self.f, 'application/x-bittorrent')}
-        return self._addFile(files=files)
+        files = {'file': (nametorrent, self.fileData, 'application/x-bittorrent')}
+        return await self._addFile(files=files)
 
-    def _addMagnetFile(self):
-        return self._addFile(data={'magnet': self.fileData})
+    async def _addMagnetFile(self):
+        return await self._addFile(data={'magnet': self.fileData})
 
     def _normalize_status(self, status, download_finished):
         if download_finished:
@@ -465,13 +982,12 @@ class Torrent(TorrentBase):
     def getHash(self):
 
         if not self._hash:
-            import bencode3
-            self._hash = hashlib.sha1(bencode3.bencode(bencode3.bdecode(self.fileData)['info'])).hexdigest()
+            self._hash = scanTorrent(self.fileData).infoHash
         
         return self._hash
 
-    def addTorrent(self):
-        return self._addTorrentFile()
+    async def addTorrent(self):
+        return await self._addTorrentFile()
 
 class Magnet(TorrentBase):
     def getHash(self):
@@ -482,8 +998,8 @@ class Magnet(TorrentBase):
         
         return self._hash
     
-    def addTorrent(self):
-        return self._addMagnetFile()
+    async def addTorrent(self):
+        return await self._addMagnetFile()
 
 
 class RealDebridTorrent(RealDebrid, Torrent):
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import sqlite3
+
+STATE_RENAMED = 'renamed'
+STATE_SUBMITTED = 'submitted'
+STATE_FILES_SELECTED = 'files_selected'
+STATE_COMPLETED = 'completed'
+STATE_LINKED = 'linked'
+STATE_FAILED = 'failed'
+
+class JobEntry():
+    def __init__(self, filePathProcessing, filename, state, folders) -> None:
+        self.filePathProcessing = filePathProcessing
+        self.filename = filename
+        self.state = state
+        self.folders = json.loads(folders) if folders else []
+
+class TorrentEntry():
+    def __init__(self, provider, torrentId, state) -> None:
+        self.provider = provider
+        self.torrentId = torrentId
+        self.state = state
+
+class ProviderStatsEntry():
+    def __init__(self, provider, hitRate, errorRate, hitSeconds, missSeconds, samples, updated) -> None:
+        self.provider = provider
+        self.hitRate = hitRate
+        self.errorRate = errorRate
+        self.hitSeconds = hitSeconds
+        self.missSeconds = missSeconds
+        self.samples = samples
+        self.updated = updated
+
+class Journal():
+    """
+    Durable record of each blackhole file's progress, keyed by its path in the processing folder,
+    so a restart can reattach to submitted torrents and skip finished steps instead of starting over.
+    """
+    journals = {}
+
+    @classmethod
+    def forPath(cls, path):
+        path = os.path.abspath(path)
+        if path not in cls.journals:
+            cls.journals[path] = cls(path)
+        return cls.journals[path]
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                filePathProcessing TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                state TEXT NOT NULL,
+                folders TEXT,
+                updated REAL NOT NULL
+            )
+        """)
+        # torrentId is left untyped so TorBox's integer ids come back as integers
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS torrents (
+                filePathProcessing TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                torrentId,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (filePathProcessing, provider)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS warmups (
+                filePathProcessing TEXT NOT NULL,
+                path TEXT NOT NULL,
+                error TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (filePathProcessing, path)
+            )
+        """)
+        # Rolling per-provider averages, kept across files and restarts
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS providerStats (
+                provider TEXT PRIMARY KEY,
+                hitRate REAL NOT NULL,
+                errorRate REAL NOT NULL,
+                hitSeconds REAL NOT NULL,
+                missSeconds REAL NOT NULL,
+                samples INTEGER NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def recordJob(self, filePathProcessing, filename, state, folders=None):
+        self.connection.execute("""
+            INSERT INTO jobs (filePathProcessing, filename, state, folders, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (filePathProcessing) DO UPDATE SET state = excluded.state, folders = COALESCE(excluded.folders, folders), updated = excluded.updated
+        """, (filePathProcessing, filename, state, json.dumps(sorted(folders)) if folders is not None else None, time.time()))
+
+    def recordTorrent(self, filePathProcessing, provider, state, torrentId=None):
+        self.connection.execute("""
+            INSERT INTO torrents (filePathProcessing, provider, torrentId, state, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (filePathProcessing, provider) DO UPDATE SET state = excluded.state, torrentId = COALESCE(excluded.torrentId, torrentId), updated = excluded.updated
+        """, (filePathProcessing, provider, torrentId, state, time.time()))
+
+    def recordWarmup(self, filePathProcessing, results):
+        """:param results: Each warmed path's error, or None if it was read."""
+        self.connection.executemany("""
+            INSERT OR REPLACE INTO warmups (filePathProcessing, path, error, updated) VALUES (?, ?, ?, ?)
+        """, [(filePathProcessing, path, error, time.time()) for path, error in results.items()])
+
+    def recordProviderStats(self, stats: ProviderStatsEntry):
+        self.connection.execute("""
+            INSERT OR REPLACE INTO providerStats (provider, hitRate, errorRate, hitSeconds, missSeconds, samples, updated) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (stats.provider, stats.hitRate, stats.errorRate, stats.hitSeconds, stats.missSeconds, stats.samples, stats.updated))
+
+    def getProviderStats(self):
+        rows = self.connection.execute("SELECT provider, hitRate, errorRate, hitSeconds, missSeconds, samples, updated FROM providerStats").fetchall()
+        return {row[0]: ProviderStatsEntry(*row) for row in rows}
+
+    def getJob(self, filePathProcessing):
+        row = self.connection.execute("SELECT filePathProcessing, filename, state, folders FROM jobs WHERE filePathProcessing = ?", (filePathProcessing,)).fetchone()
+        return JobEntry(*row) if row else None
+
+    def getTorrent(self, filePathProcessing, provider):
+        row = self.connection.execute("SELECT provider, torrentId, state FROM torrents WHERE filePathProcessing = ? AND provider = ?", (filePathProcessing, provider)).fetchone()
+        return TorrentEntry(*row) if row else None
+
+    def remove(self, filePathProcessing):
+        self.connection.execute("DELETE FROM jobs WHERE filePathProcessing = ?", (filePathProcessing,))
+        self.connection.execute("DELETE FROM torrents WHERE filePathProcessing = ?", (filePathProcessing,))
+        self.connection.execute("DELETE FROM warmups WHERE filePathProcessing = ?", (filePathProcessing,))
@@ -0,0 +1,70 @@
+import os
+import re
+
+multiSeasonRegex1 = re.compile(r'(?<=[\W_][Ss]eason[\W_])[\d][\W_][\d]{1,2}(?=[\W_])')
+multiSeasonRegex2 = re.compile(r'(?<=[\W_][Ss])[\d]{2}[\W_][Ss]?[\d]{2}(?=[\W_])')
+multiSeasonRegexCombined = re.compile(f'{multiSeasonRegex1.pattern}|{multiSeasonRegex2.pattern}')
+seasonEpisodeRegex = re.compile(r'S([\d]{2})E[\d]{2}')
+
+class LinkPlan():
+    def __init__(self) -> None:
+        self.links = []
+        self.folders = set()
+        self.rootFolders = set()
+
+    def add(self, source, target, rootFolder, isSeason):
+        self.links.append((source, target, isSeason))
+        self.folders.add(os.path.dirname(target))
+        self.rootFolders.add(rootFolder)
+
+def getSeasonFolder(folder, season, customRegex=None):
+    """Replace the multi-season range in a folder's name with a single season."""
+    seasonShort = season[1:] if season[0] == '0' else season
+    parent, name = os.path.split(folder)
+
+    # Keep a separator in front so the lookbehinds match at the start of the name, as they do within a full path
+    name = multiSeasonRegex1.sub(seasonShort, os.sep + name)
+    name = multiSeasonRegex2.sub(season, name)[1:]
+    if customRegex:
+        name = re.sub(customRegex, f' Season {seasonShort} S{season} ', name)
+
+    return os.path.join(parent, name)
+
+def buildLinkPlan(sourceFolder, targetFolder, name, customRegex=None) -> LinkPlan:
+    """
+    Walk sourceFolder and plan a link inside targetFolder for every file.
+    If name contains a multi-season range, episodes are planned into a folder per season instead.
+    """
+    plan = LinkPlan()
+    multiSeasonMatch = multiSeasonRegexCombined.search(name) or (customRegex and re.search(customRegex, name))
+    seasonFolders = {}
+
+    for root, dirs, files in os.walk(sourceFolder):
+        relRoot = os.path.relpath(root, sourceFolder)
+        for filename in files:
+            seasonMatch = multiSeasonMatch and seasonEpisodeRegex.search(filename)
+            if seasonMatch:
+                season = seasonMatch.group(1)
+                if season not in seasonFolders:
+                    seasonFolders[season] = getSeasonFolder(targetFolder, season, customRegex)
+                rootFolder = seasonFolders[season]
+            else:
+                rootFolder = targetFolder
+
+            plan.add(os.path.join(root, filename), os.path.normpath(os.path.join(rootFolder, relRoot, filename)), rootFolder, bool(seasonMatch))
+
+    return plan
+
+def printLinkPlan(plan: LinkPlan, print=print):
+    for source, target, isSeason in plan.links:
+        print('Season Recursive:' if isSeason else 'Recursive:', f"{target} -> {source}")
+
+def materializeLinkPlan(plan: LinkPlan, print=print):
+    """Create the planned folders, each once, then the links. Blocking, so run it in a worker thread from async code."""
+    for folder in sorted(plan.folders):
+        os.makedirs(folder, exist_ok=True)
+
+    for source, target, isSeason in plan.links:
+        os.symlink(source, target)
+
+    printLinkPlan(plan, print)
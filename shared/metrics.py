@@ -0,0 +1,189 @@
+import json
+import time
+import bisect
+import threading
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Counter():
+    def __init__(self, name, help, labelNames) -> None:
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with registry.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+    def status(self):
+        return {formatLabels(self.labelNames, labels): value for labels, value in self.values.items()}
+
+class Histogram():
+    defaultBuckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, name, help, labelNames, buckets=defaultBuckets) -> None:
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        # labels -> [count per bucket (plus +Inf), sum]
+        self.values = {}
+
+    def observe(self, *labels, value):
+        with registry.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (('le', str(bound)),), cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+    def quantile(self, counts, q):
+        """Upper bound of the bucket holding the q quantile, None if it's past the last bucket."""
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def status(self):
+        return {
+            formatLabels(self.labelNames, labels): {
+                'count': sum(counts),
+                'mean': total / sum(counts),
+                'p50': self.quantile(counts, 0.5),
+                'p95': self.quantile(counts, 0.95)
+            }
+            for labels, (counts, total) in self.values.items()
+        }
+
+class Gauge():
+    """A gauge read from callback when scraped, so the state it reports never has to be mirrored."""
+    def __init__(self, name, help, labelNames, callback) -> None:
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.callback = callback
+
+    def read(self):
+        try:
+            return dict(self.callback())
+        except RuntimeError:
+            # The event loop changed what the callback was iterating over, the next scrape will catch up
+            return {}
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.read().items()]
+
+    def status(self):
+        return {formatLabels(self.labelNames, labels): value for labels, value in self.read().items()}
+
+def formatLabels(labelNames, labels):
+    return ','.join(f"{name}={value}" for name, value in zip(labelNames, labels)) or 'total'
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Registry():
+    def __init__(self) -> None:
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def counter(self, name, help, labelNames=()):
+        return self.metrics.setdefault(name, Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), **kwargs):
+        return self.metrics.setdefault(name, Histogram(name, help, labelNames, **kwargs))
+
+    def gauge(self, name, help, labelNames, callback):
+        self.metrics[name] = Gauge(name, help, labelNames, callback)
+        return self.metrics[name]
+
+    def prometheus(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                kind = metric.__class__.__name__.lower()
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {kind}")
+                for name, labels, value in metric.samples():
+                    # Histogram buckets append their le label to the positional ones
+                    pairs = list(zip(metric.labelNames, labels)) + [label for label in labels[len(metric.labelNames):]]
+                    labelText = ','.join(f'{key}="{escapeLabel(labelValue)}"' for key, labelValue in pairs)
+                    lines.append(f"{name}{{{labelText}}} {value}" if labelText else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def status(self):
+        with self.lock:
+            return {
+                'uptimeSeconds': round(time.time() - self.started),
+                **{metric.name: metric.status() for metric in self.metrics.values()}
+            }
+
+registry = Registry()
+
+requestSeconds = registry.histogram('blackhole_request_seconds', 'Latency of HTTP requests to RealDebrid, TorBox and the Arrs, per attempt', ('host', 'method'))
+requestErrors = registry.counter('blackhole_request_errors_total', 'HTTP request attempts that failed with a non 2xx status or an exception', ('host', 'reason'))
+mountProbeSeconds = registry.histogram('blackhole_mount_probe_seconds', 'Latency of listing and reading through the debrid mount', ('operation',), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+stageSeconds = registry.histogram('blackhole_stage_seconds', 'Time spent in each stage of processing a torrent', ('provider', 'stage'))
+torrentsProcessed = registry.counter('blackhole_torrents_processed_total', 'Torrents processed, by outcome', ('provider', 'outcome'))
+
+def getHost(url):
+    try:
+        return urlsplit(str(url)).netloc or 'unknown'
+    except ValueError:
+        return 'unknown'
+
+def observeRequest(method, url, seconds, statusCode=None, exception=None):
+    """Record one request attempt made through retryRequest or retryRequestAsync."""
+    host = getHost(url)
+    requestSeconds.observe(host, method, value=seconds)
+    if exception is not None:
+        requestErrors.inc(host, exception.__class__.__name__)
+    elif not 200 <= statusCode < 300:
+        requestErrors.inc(host, str(statusCode))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            self.respond(registry.prometheus(), 'text/plain; version=0.0.4')
+        elif path in ('/', '/status'):
+            self.respond(json.dumps(registry.status(), indent=2, default=str), 'application/json')
+        else:
+            self.send_error(404)
+
+    def respond(self, body, contentType):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f"{contentType}; charset=utf-8")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetricsServer(port, host='0.0.0.0'):
+    """Serve /metrics (Prometheus) and /status (JSON) from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"Serving metrics on port {port}")
+    return server
@@ -0,0 +1,341 @@
+import os
+import math
+import time
+import errno
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shared.shared import blackhole, mediaExtensions
+from shared.metrics import mountProbeSeconds
+
+class MountIndex():
+    """
+    In-memory index of the top-level torrent folders of a debrid mount.
+    One scan per tick (or inotify events, where the FUSE layer delivers them) serves every torrent waiting for its folder,
+    instead of each torrent probing the mount itself.
+    """
+    _indexes = {}
+
+    @classmethod
+    def forPath(cls, path):
+        # Normalized so a configured trailing slash doesn't split the index or hide inotify events
+        path = os.path.normpath(path)
+        if path not in cls._indexes:
+            cls._indexes[path] = cls(path)
+        return cls._indexes[path]
+
+    def __init__(self, path, interval=1, inotifyScanInterval=10) -> None:
+        self.path = os.path.normpath(path)
+        self.interval = interval
+        self.inotifyScanInterval = inotifyScanInterval
+        self.names = set()
+        self.waiters = []
+        self.task = None
+        self.loop = None
+        self.wakeEvent = None
+        self.observer = None
+        self.lastScan = 0
+
+    async def waitFor(self, names, timeout):
+        """
+        Wait for one of the candidate folders to appear in the mount with something inside it.
+
+        :param names: Candidate folder names, in order of preference.
+        :param timeout: Seconds to wait before giving up.
+        :return: The full path of the first candidate found, or None if none appeared in time.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((names, future, time.monotonic() + timeout))
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+        return await future
+
+    async def _run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeEvent = asyncio.Event()
+        if blackhole['mountInotify'] and self.observer is None:
+            self._startObserver()
+
+        while self.waiters:
+            scanInterval = self.inotifyScanInterval if self.observer else self.interval
+            if time.monotonic() - self.lastScan >= scanInterval:
+                self.lastScan = time.monotonic()
+                try:
+                    self.names = await asyncio.to_thread(self._scan)
+                except OSError as e:
+                    print(f"Error scanning {self.path}: {e}")
+
+            for waiter in list(self.waiters):
+                names, future, deadline = waiter
+                folderPath = None
+                if not future.done():
+                    for name in names:
+                        # The folder can show up before its contents do
+                        if name in self.names and await asyncio.to_thread(self._hasChildren, name):
+                            folderPath = os.path.join(self.path, name)
+                            break
+
+                if future.done():
+                    self.waiters.remove(waiter)
+                elif folderPath or time.monotonic() >= deadline:
+                    future.set_result(folderPath)
+                    self.waiters.remove(waiter)
+
+            if self.waiters:
+                self.wakeEvent.clear()
+                try:
+                    await asyncio.wait_for(self.wakeEvent.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _scan(self):
+        start = time.monotonic()
+        try:
+            with os.scandir(self.path) as entries:
+                return {entry.name for entry in entries}
+        finally:
+            mountProbeSeconds.observe('scan', value=time.monotonic() - start)
+
+    def _hasChildren(self, name):
+        start = time.monotonic()
+        try:
+            with os.scandir(os.path.join(self.path, name)) as entries:
+                return any(True for _ in entries)
+        except OSError:
+            return False
+        finally:
+            mountProbeSeconds.observe('folder', value=time.monotonic() - start)
+
+    def _onEntry(self, name):
+        self.names.add(name)
+        self.wakeEvent.set()
+
+    def _startObserver(self):
+        try:
+            from watchdog.observers.inotify import InotifyObserver
+            from watchdog.events import FileSystemEventHandler
+        except ImportError as e:
+            print(f"inotify unavailable, scanning {self.path} instead: {e}")
+            return
+
+        index = self
+
+        class Handler(FileSystemEventHandler):
+            def on_created(self, event):
+                self._notify(event.src_path)
+
+            def on_moved(self, event):
+                self._notify(event.dest_path)
+
+            def _notify(self, path):
+                if os.path.dirname(os.path.normpath(path)) == index.path:
+                    index.loop.call_soon_threadsafe(index._onEntry, os.path.basename(path))
+
+        try:
+            observer = InotifyObserver()
+            observer.schedule(Handler(), self.path)
+            observer.daemon = True
+            observer.start()
+            self.observer = observer
+        except OSError as e:
+            print(f"inotify unavailable, scanning {self.path} instead: {e}")
+
+class WarmupPool():
+    """
+    Process-wide bounded pool that reads the start and end of newly linked media through the mount,
+    so the first playback doesn't wait on the mount fetching them, and unreachable files are noticed before the Arr imports them.
+    A read that times out keeps its thread until the mount returns, so stuck reads count against the pool rather than piling up.
+    Each file's timeout starts when its read does. A file still waiting for a reader after its share of the timeouts is skipped rather than reported unreachable.
+    """
+    _pool = None
+    SKIPPED = "Skipped, no reader was free in time"
+
+    @classmethod
+    def get(cls):
+        if cls._pool is None:
+            cls._pool = cls(blackhole['warmupWorkers'], blackhole['warmupMiB'] * 1024 * 1024, blackhole['warmupTimeout'])
+        return cls._pool
+
+    def __init__(self, workers, readBytes, timeout) -> None:
+        self.workers = workers
+        self.readBytes = readBytes
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='warmup')
+        self.semaphore = None
+
+    async def warm(self, paths):
+        """
+        Read the first and last readBytes of every media file in paths.
+
+        :return: A dict of each media file's error, None if it was read in time, or SKIPPED if it never got a reader.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+
+        paths = [path for path in paths if os.path.splitext(path)[1].lower() in mediaExtensions]
+        # Long enough for every file to get a reader even if each read runs to the timeout, so a mount that hangs every read can't stall the caller
+        readerDeadline = asyncio.get_running_loop().time() + self.timeout * math.ceil(len(paths) / self.workers)
+        results = await asyncio.gather(*(self._warmFile(path, readerDeadline) for path in paths))
+        return dict(zip(paths, results))
+
+    async def _warmFile(self, path, readerDeadline):
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=max(readerDeadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            return self.SKIPPED
+
+        future = loop.run_in_executor(self.executor, self._read, path)
+        # Released when the read actually finishes, not when it times out
+        future.add_done_callback(lambda _: self.semaphore.release())
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            return f"Timed out after {self.timeout}s"
+        except OSError as e:
+            return str(e)
+
+    def _read(self, path):
+        start = time.monotonic()
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                f.read(self.readBytes)
+                if size > self.readBytes * 2:
+                    f.seek(size - self.readBytes)
+                    f.read(self.readBytes)
+        finally:
+            mountProbeSeconds.observe('warmup', value=time.monotonic() - start)
+
+class TokenBucket():
+    """Thread-safe byte budget refilled at rate bytes per second, holding at most one second's worth."""
+    def __init__(self, rate) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        """Block until count bytes may be transferred."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate)
+            self.updated = now
+            # Going into debt keeps chunks larger than the bucket working, later callers wait it off
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class CopyPool():
+    """
+    Process-wide pool that copies a link plan's files out of the mount instead of symlinking them.
+    Files are copied in parallel, each in chunks through the fastest of copy_file_range, sendfile or read/write the kernel accepts,
+    into a .partial file that a later attempt resumes from, and is only renamed into place once its size matches the source.
+    """
+    _pool = None
+    partialSuffix = '.partial'
+    # Errors meaning the kernel or filesystem doesn't support a copy method, rather than that the copy failed
+    unsupportedErrors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+    @classmethod
+    def get(cls):
+        if cls._pool is None:
+            maxBytesPerSecond = blackhole['copyMaxMiBps'] * 1024 * 1024
+            cls._pool = cls(blackhole['copyWorkers'], TokenBucket(maxBytesPerSecond) if maxBytesPerSecond else None)
+        return cls._pool
+
+    def __init__(self, workers, bucket=None, chunkSize=8 * 1024 * 1024) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy')
+        self.bucket = bucket
+        self.chunkSize = chunkSize
+
+    async def copy(self, plan, print=print):
+        """
+        Copy every file in the plan to its target.
+
+        :return: A dict of the error for each file that couldn't be copied. Empty if all were copied and verified.
+        """
+        await asyncio.to_thread(self._makeFolders, plan)
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, self._copyFile, source, target) for source, target, isSeason in plan.links), return_exceptions=True)
+
+        errors = {target: str(result) for (source, target, isSeason), result in zip(plan.links, results) if isinstance(result, Exception)}
+        copiedBytes = sum(result for result in results if not isinstance(result, Exception))
+        seconds = time.monotonic() - start
+        print(f"Copied {len(plan.links) - len(errors)}/{len(plan.links)} files, {copiedBytes / 1024 / 1024:.1f} MiB in {seconds:.1f}s ({copiedBytes / 1024 / 1024 / max(seconds, 0.001):.1f} MiB/s)")
+
+        return errors
+
+    def _makeFolders(self, plan):
+        for folder in sorted(plan.folders):
+            os.makedirs(folder, exist_ok=True)
+
+    def _copyFile(self, source, target):
+        """Copy source to target, resuming a previous partial copy. Returns the number of bytes copied by this call."""
+        size = os.stat(source).st_size
+        if os.path.exists(target) and os.path.getsize(target) == size:
+            return 0
+
+        partial = target + self.partialSuffix
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset > size:
+            offset = 0
+        resumedFrom = offset
+
+        sourceFd = os.open(source, os.O_RDONLY)
+        try:
+            targetFd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(targetFd, offset)
+                methods = [self._copyFileRange, self._sendfile, self._readWrite]
+                while offset < size:
+                    count = min(self.chunkSize, size - offset)
+                    if self.bucket:
+                        self.bucket.consume(count)
+
+                    copied = self._copyChunk(methods, sourceFd, targetFd, offset, count)
+                    if not copied:
+                        raise OSError(f"{source} ended at {offset} of {size} bytes")
+                    offset += copied
+            finally:
+                os.close(targetFd)
+        finally:
+            os.close(sourceFd)
+
+        if os.path.getsize(partial) != size:
+            raise OSError(f"Copied size of {target} does not match the source")
+        os.replace(partial, target)
+
+        return size - resumedFrom
+
+    def _copyChunk(self, methods, sourceFd, targetFd, offset, count):
+        """Copy with the first of methods that works, dropping the ones that turn out to be unsupported."""
+        while True:
+            try:
+                return methods[0](sourceFd, targetFd, offset, count)
+            except OSError as e:
+                if e.errno not in self.unsupportedErrors or len(methods) == 1:
+                    raise
+                methods.pop(0)
+
+    def _copyFileRange(self, sourceFd, targetFd, offset, count):
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, "copy_file_range is unavailable")
+        return os.copy_file_range(sourceFd, targetFd, count, offset, offset)
+
+    def _sendfile(self, sourceFd, targetFd, offset, count):
+        # sendfile writes at the target's position rather than taking an offset
+        os.lseek(targetFd, offset, os.SEEK_SET)
+        return os.sendfile(targetFd, sourceFd, offset, count)
+
+    def _readWrite(self, sourceFd, targetFd, offset, count):
+        data = os.pread(sourceFd, count, offset)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(targetFd, data[written:], offset + written)
+        return written
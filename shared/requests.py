@@ -1,8 +1,76 @@
 import time
+import asyncio
+import threading
 import requests
-from typing import Callable, Optional
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
 from shared.discord import discordError, discordUpdate
+from shared.metrics import observeRequest, getHost
 
+# httpx is only installed for blackhole, so the scripts sharing the synchronous helpers don't need it
+if TYPE_CHECKING:
+    import httpx
+
+_asyncClient = None
+_asyncClientLoop = None
+
+def getAsyncClient() -> 'httpx.AsyncClient':
+    """
+    Get the pooled keep-alive client for the running event loop, creating it on first use.
+
+    :return: The shared async HTTP client.
+    """
+    import httpx
+
+    global _asyncClient, _asyncClientLoop
+    loop = asyncio.get_running_loop()
+    if _asyncClient is None or _asyncClient.is_closed or _asyncClientLoop is not loop:
+        _asyncClient = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, connect=10),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+        _asyncClientLoop = loop
+    return _asyncClient
+
+async def closeAsyncClient():
+    global _asyncClient
+    if _asyncClient is not None and _asyncClientLoop is asyncio.get_running_loop():
+        await _asyncClient.aclose()
+    _asyncClient = None
+
+
+class RateLimiter():
+    """
+    Thread-safe limit on the requests per second sent to a host, shared by every thread calling it.
+    Requests are spaced evenly rather than sent in bursts.
+    """
+    _limiters = {}
+
+    @classmethod
+    def forHost(cls, url):
+        """:return: The host's limiter, or None if it is unlimited."""
+        return cls._limiters.get(getHost(url))
+
+    @classmethod
+    def setLimit(cls, url, rate):
+        """Limit the host of url to rate requests per second, or remove its limit if rate is falsy."""
+        if rate:
+            cls._limiters[getHost(url)] = cls(rate)
+        else:
+            cls._limiters.pop(getHost(url), None)
+
+    def __init__(self, rate) -> None:
+        self.interval = 1 / rate
+        self.nextTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            sendTime = max(now, self.nextTime)
+            self.nextTime = sendTime + self.interval
+        if sendTime > now:
+            time.sleep(sendTime - now)
 
 def retryRequest(
     requestFunc: Callable[[], requests.Response], 
@@ -21,8 +89,10 @@ def retryRequest(
     """
     attempts = retries + 1  # Total attempts including the initial one
     for attempt in range(attempts):
+        start = time.monotonic()
         try:
             response = requestFunc()
+            observeRequest(response.request.method, response.url, time.monotonic() - start, response.status_code)
             if 200 <= response.status_code < 300:
                 return response
             else:
@@ -43,6 +113,7 @@ def retryRequest(
                     print(f"Retrying in {delay} seconds...")
                     time.sleep(delay)
         except requests.RequestException as e:
+            observeRequest(e.request.method if e.request else 'unknown', e.request.url if e.request else None, time.monotonic() - start, exception=e)
             message = [
                 f"URL: {response.url if 'response' in locals() else 'unknown'}",
                 f"Attempt {attempt + 1} encountered an error: {e}"
@@ -57,4 +128,65 @@ def retryRequest(
                 print(f"Retrying in {delay} seconds...")
                 time.sleep(delay)
     
+    return None
+
+async def retryRequestAsync(
+    requestFunc: Callable[[], Awaitable['httpx.Response']], 
+    print: Callable[..., None] = print, 
+    retries: int = 1, 
+    delay: int = 1
+) -> Optional['httpx.Response']:
+    """
+    Retry an async request if the response status code is not in the 200 range, without blocking the event loop.
+
+    :param requestFunc: A callable that returns an awaitable HTTP response, e.g. lambda: getAsyncClient().get(url).
+    :param print: Optional print function for logging.
+    :param retries: The number of times to retry the request after the initial attempt.
+    :param delay: The delay between retries in seconds.
+    :return: The response object or None if all attempts fail.
+    """
+    import httpx
+
+    attempts = retries + 1  # Total attempts including the initial one
+    for attempt in range(attempts):
+        start = time.monotonic()
+        try:
+            response = await requestFunc()
+            observeRequest(response.request.method, response.url, time.monotonic() - start, response.status_code)
+            if 200 <= response.status_code < 300:
+                return response
+            else:
+                message = [
+                    f"URL: {response.url}",
+                    f"Status code: {response.status_code}",
+                    f"Message: {response.reason_phrase}",
+                    f"Response: {response.content}",
+                    f"Attempt {attempt + 1} failed"
+                ]
+                for line in message:
+                    print(line)
+                if attempt == retries:
+                    await asyncio.to_thread(discordError, "Request Failed", "\n".join(message))
+                else:
+                    update_message = message + [f"Retrying in {delay} seconds..."]
+                    await asyncio.to_thread(discordUpdate, "Retrying Request", "\n".join(update_message))
+                    print(f"Retrying in {delay} seconds...")
+                    await asyncio.sleep(delay)
+        except httpx.HTTPError as e:
+            request = e.request if isinstance(e, httpx.RequestError) else None
+            observeRequest(request.method if request else 'unknown', request.url if request else None, time.monotonic() - start, exception=e)
+            message = [
+                f"URL: {e.request.url if isinstance(e, httpx.RequestError) else 'unknown'}",
+                f"Attempt {attempt + 1} encountered an error: {e!r}"
+            ]
+            for line in message:
+                print(line)
+            if attempt == retries:
+                await asyncio.to_thread(discordError, "Request Exception", "\n".join(message))
+            else:
+                update_message = message + [f"Retrying in {delay} seconds..."]
+                await asyncio.to_thread(discordUpdate, "Retrying Request", "\n".join(update_message))
+                print(f"Retrying in {delay} seconds...")
+                await asyncio.sleep(delay)
+    
     return None
\ No newline at end of file
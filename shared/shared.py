@@ -8,7 +8,7 @@ env.read_env()
 default_pattern = r"<[a-z0-9_]+>"
 
 def commonEnvParser(value, convert=None):
-    if value is not None and re.match(default_pattern, value):
+    if value is None or (isinstance(value, str) and re.match(default_pattern, value)):
         return None
     return convert(value) if convert else value
 
@@ -34,6 +34,21 @@ blackhole = {
     'rdMountRefreshSeconds': env.integer('BLACKHOLE_RD_MOUNT_REFRESH_SECONDS', default=None),
     'waitForTorrentTimeout': env.integer('BLACKHOLE_WAIT_FOR_TORRENT_TIMEOUT', default=None),
     'historyPageSize': env.integer('BLACKHOLE_HISTORY_PAGE_SIZE', default=None),
+    'workers': env.integer('BLACKHOLE_WORKERS', default=20),
+    'rdMaxInflight': env.integer('BLACKHOLE_RD_MAX_INFLIGHT', default=0),
+    'torboxMaxInflight': env.integer('BLACKHOLE_TORBOX_MAX_INFLIGHT', default=0),
+    'rdRaceDelay': env.integer('BLACKHOLE_RD_RACE_DELAY', default=0),
+    'torboxRaceDelay': env.integer('BLACKHOLE_TORBOX_RACE_DELAY', default=0),
+    'mountInotify': env.bool('BLACKHOLE_MOUNT_INOTIFY', default=False),
+    'journalPath': env.string('BLACKHOLE_JOURNAL_PATH', default=None),
+    'warmupWorkers': env.integer('BLACKHOLE_WARMUP_WORKERS', default=4),
+    'warmupMiB': env.integer('BLACKHOLE_WARMUP_MIB', default=8),
+    'warmupTimeout': env.integer('BLACKHOLE_WARMUP_TIMEOUT', default=30),
+    'copy': env.bool('BLACKHOLE_COPY', default=False),
+    'copyWorkers': env.integer('BLACKHOLE_COPY_WORKERS', default=4),
+    'copyMaxMiBps': env.integer('BLACKHOLE_COPY_MAX_MIBPS', default=0),
+    'metricsPort': env.integer('BLACKHOLE_METRICS_PORT', default=0),
+    'instances': [suffix.strip() for suffix in env.list('BLACKHOLE_INSTANCES', default=[]) if suffix.strip()],
 }
 
 server = {
@@ -66,6 +81,25 @@ radarr = {
     'apiKey': env.string('RADARR_API_KEY', default=None)
 }
 
+# The default Sonarr/Radarr pair, plus one pair per BLACKHOLE_INSTANCES suffix (e.g. 4K reads SONARR_HOST_4K and watches "<BLACKHOLE_SONARR_PATH> 4k")
+blackholeInstances = [{
+    'name': None,
+    'sonarrPath': blackhole['sonarrPath'],
+    'radarrPath': blackhole['radarrPath'],
+    'sonarrHost': sonarr['host'],
+    'sonarrApiKey': sonarr['apiKey'],
+    'radarrHost': radarr['host'],
+    'radarrApiKey': radarr['apiKey']
+}] + [{
+    'name': suffix.lower(),
+    'sonarrPath': env.string(f'BLACKHOLE_SONARR_PATH_{suffix.upper()}', default=f"{blackhole['sonarrPath']} {suffix.lower()}"),
+    'radarrPath': env.string(f'BLACKHOLE_RADARR_PATH_{suffix.upper()}', default=f"{blackhole['radarrPath']} {suffix.lower()}"),
+    'sonarrHost': env.string(f'SONARR_HOST_{suffix.upper()}', default=None),
+    'sonarrApiKey': env.string(f'SONARR_API_KEY_{suffix.upper()}', default=None),
+    'radarrHost': env.string(f'RADARR_HOST_{suffix.upper()}', default=None),
+    'radarrApiKey': env.string(f'RADARR_API_KEY_{suffix.upper()}', default=None)
+} for suffix in blackhole['instances']]
+
 tautulli = {
     'host': env.string('TAUTULLI_HOST', default=None),
     'apiKey': env.string('TAUTULLI_API_KEY', default=None)
@@ -81,6 +115,7 @@ realdebrid = {
 torbox = {
     'enabled': env.bool('TORBOX_ENABLED', default=None),
     'host': env.string('TORBOX_HOST', default=None),
+    'relayHost': env.string('TORBOX_RELAY_HOST', default='https://relay.torbox.app/'),
     'apiKey': env.string('TORBOX_API_KEY', default=None),
     'mountTorrentsPath': env.string('TORBOX_MOUNT_TORRENTS_PATH', default=None)
 }
@@ -97,7 +132,9 @@ discord = {
 
 repair = {
     'repairInterval': env.string('REPAIR_REPAIR_INTERVAL', default=None),
-    'runInterval': env.string('REPAIR_RUN_INTERVAL', default=None)
+    'runInterval': env.string('REPAIR_RUN_INTERVAL', default=None),
+    'workers': env.integer('REPAIR_WORKERS', default=8),
+    'rateLimit': env.integer('REPAIR_RATE_LIMIT', default=10)
 }
 
 plexHeaders = {